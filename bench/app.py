@@ -2,6 +2,7 @@
 from __future__ import print_function
 
 # imports - standard imports
+import glob
 import json
 import logging
 import os
@@ -9,23 +10,26 @@ import re
 import shutil
 import subprocess
 import sys
+import time
+from collections import OrderedDict
 
 # imports - third party imports
 import click
-import git
-import requests
-import semantic_version
 from six.moves import reload_module
 
 # imports - module imports
 import bench
+from bench import trace
 from bench.config.common_site_config import get_config
-from bench.utils import CommandFailedError, build_assets, check_git_for_shallow_clone, exec_cmd, get_cmd_output, get_frappe, restart_supervisor_processes, restart_systemd_processes, run_frappe_cmd
+from bench.utils import CommandFailedError, build_assets, exec_cmd, exec_pip_install, file_lock, get_clone_strategy, get_cmd_output, get_frappe, makedirs_safe, restart_supervisor_processes, restart_systemd_processes, run_frappe_cmd
 
 
 logging.basicConfig(level="INFO")
 logger = logging.getLogger(__name__)
 
+git_metadata_cache = {}
+refreshed_git_mirrors = set()
+
 
 class InvalidBranchException(Exception): pass
 class InvalidRemoteException(Exception): pass
@@ -98,7 +102,10 @@ def remove_from_excluded_apps_txt(app, bench_path='.'):
 		apps.remove(app)
 		return write_excluded_apps_txt(apps, bench_path=bench_path)
 
+@trace.traced
 def get_app(git_url, branch=None, bench_path='.', skip_assets=False, verbose=False, postprocess=True, overwrite=False):
+	import requests
+
 	if not os.path.exists(git_url):
 		if not check_url(git_url, raise_err=False):
 			orgs = ['frappe', 'erpnext']
@@ -114,11 +121,12 @@ def get_app(git_url, branch=None, bench_path='.', skip_assets=False, verbose=Fal
 
 		# Gets repo name from URL
 		repo_name = git_url.rsplit('/', 1)[1].rsplit('.', 1)[0]
-		shallow_clone = '--depth 1' if check_git_for_shallow_clone() else ''
+		clone_strategy = get_clone_strategy(bench_path=bench_path)
+		clone_flags = {'shallow': '--depth 1', 'blobless': '--filter=blob:none'}.get(clone_strategy, '')
 		branch = '--branch {branch}'.format(branch=branch) if branch else ''
 	else:
 		repo_name = git_url.split(os.sep)[-1]
-		shallow_clone = ''
+		clone_flags = ''
 		branch = '--branch {branch}'.format(branch=branch) if branch else ''
 
 	if os.path.isdir(os.path.join(bench_path, 'apps', repo_name)):
@@ -132,10 +140,14 @@ Do you want to continue and overwrite it?'''.format(repo_name)):
 			install_app(app=app_name, bench_path=bench_path, verbose=verbose, skip_assets=skip_assets)
 			sys.exit()
 
+	git_mirror = get_git_mirror(git_url, bench_path=bench_path)
+	reference = '--reference {0} --dissociate'.format(git_mirror) if git_mirror else ''
+
 	logger.info('Getting app {0}'.format(repo_name))
-	exec_cmd("git clone {git_url} {branch} {shallow_clone} --origin upstream".format(
+	exec_cmd("git clone {git_url} {branch} {clone_flags} {reference} --origin upstream".format(
 		git_url=git_url,
-		shallow_clone=shallow_clone,
+		clone_flags=clone_flags,
+		reference=reference,
 		branch=branch),
 		cwd=os.path.join(bench_path, 'apps'))
 
@@ -170,15 +182,15 @@ def new_app(app, bench_path='.'):
 
 
 def install_app(app, bench_path=".", verbose=False, no_cache=False, postprocess=True, skip_assets=False):
+	"""Installs the app in the bench's env and returns pip's exit code"""
 	logger.info("installing {}".format(app))
 
-	pip_path = os.path.join(bench_path, "env", "bin", "pip")
 	quiet_flag = "-q" if not verbose else ""
 	app_path = os.path.join(bench_path, "apps", app)
 	cache_flag = "--no-cache-dir" if no_cache else ""
 
-	exec_cmd("{pip} install {quiet} -U -e {app} {no_cache}".format(pip=pip_path,
-									quiet=quiet_flag, app=app_path, no_cache=cache_flag))
+	return_code = exec_pip_install("{quiet} -U -e {app} {no_cache}".format(quiet=quiet_flag, app=app_path, no_cache=cache_flag),
+		bench_path=bench_path, apps=[app])
 	add_to_appstxt(app, bench_path=bench_path)
 
 	if postprocess:
@@ -191,6 +203,24 @@ def install_app(app, bench_path=".", verbose=False, no_cache=False, postprocess=
 		if conf.get('restart_systemd_on_update'):
 			restart_systemd_processes(bench_path=bench_path)
 
+	return return_code
+
+
+def install_apps(apps, bench_path=".", verbose=False, no_cache=False):
+	"""Installs the apps with a single pip run, so that their requirements are resolved together.
+	If pip can't resolve them together, they're installed one at a time instead. Returns the
+	apps that couldn't be installed"""
+	quiet_flag = "-q" if not verbose else ""
+	app_paths = " ".join("-e {0}".format(os.path.join(bench_path, "apps", app)) for app in apps)
+	cache_flag = "--no-cache-dir" if no_cache else ""
+
+	if exec_pip_install("{quiet} -U {apps} {no_cache}".format(quiet=quiet_flag, apps=app_paths, no_cache=cache_flag),
+		bench_path=bench_path, apps=apps) == 0:
+		return []
+
+	bench.utils.log("Installing {0} together failed, installing them one at a time".format(", ".join(apps)), level=3)
+	return [app for app in apps if install_app(app, bench_path=bench_path, verbose=verbose, no_cache=no_cache, postprocess=False)]
+
 
 def remove_app(app, bench_path='.'):
 	if app not in get_apps(bench_path):
@@ -218,23 +248,36 @@ def remove_app(app, bench_path='.'):
 	if get_config(bench_path).get('restart_systemd_on_update'):
 		restart_systemd_processes(bench_path=bench_path)
 
-def pull_all_apps(bench_path='.', reset=False):
+@trace.traced
+def pull_all_apps(bench_path='.', reset=False, jobs=1, skip_apps=()):
 	'''Check all apps if there no local changes, pull'''
+	from bench.utils import compile_python_files, get_bench_state, log, print_summary_table, record_update_progress, run_parallel, set_bench_state
+
 	rebase = '--rebase' if get_config(bench_path).get('rebase_on_pull') else ''
+	excluded_apps = get_excluded_apps(bench_path=bench_path)
+	prefetched = get_bench_state('prefetch', bench_path=bench_path)
+	apps = get_apps(bench_path=bench_path)
+	summary = []
+
+	for app in apps:
+		if app in excluded_apps:
+			print("Skipping pull for app {}".format(app))
+			summary.append((app, 'skipped', 'excluded from updates', ''))
+		elif app in skip_apps:
+			summary.append((app, 'skipped', 'already pulled', ''))
+	apps = [app for app in apps if app not in excluded_apps and app not in skip_apps
+		and os.path.exists(os.path.join(get_repo_dir(app, bench_path=bench_path), '.git'))]
 
 	# chech for local changes
 	if not reset:
-		for app in get_apps(bench_path=bench_path):
-			excluded_apps = get_excluded_apps()
-			if app in excluded_apps:
-				print("Skipping reset for app {}".format(app))
-				continue
-			app_dir = get_repo_dir(app, bench_path=bench_path)
-			if os.path.exists(os.path.join(app_dir, '.git')):
-				out = subprocess.check_output(["git", "status"], cwd=app_dir)
-				out = out.decode('utf-8')
-				if not re.search(r'nothing to commit, working (directory|tree) clean', out):
-					print('''
+		def has_local_changes(app):
+			out = subprocess.check_output(["git", "status"], cwd=get_repo_dir(app, bench_path=bench_path))
+			out = out.decode('utf-8')
+			return not re.search(r'nothing to commit, working (directory|tree) clean', out)
+
+		dirty_apps = [app for app, dirty in zip(apps, run_parallel(has_local_changes, apps, jobs=jobs)) if dirty]
+		if dirty_apps:
+			print('''
 
 Cannot proceed with update: You have local changes in app "{0}" that are not committed.
 
@@ -244,36 +287,172 @@ Here are your choices:
 1. Temporarily remove your changes with "git stash" or discard them completely
 	with "bench update --reset" or for individual repositries "git reset --hard"
 2. If your changes are helpful for others, send in a pull request via GitHub and
-	wait for them to be merged in the core.'''.format(app))
-					sys.exit(1)
+	wait for them to be merged in the core.'''.format(", ".join(dirty_apps)))
+			sys.exit(1)
 
-	excluded_apps = get_excluded_apps()
-	for app in get_apps(bench_path=bench_path):
-		if app in excluded_apps:
-			print("Skipping pull for app {}".format(app))
-			continue
+	changed_python_files = []
+
+	def pull_app(app):
 		app_dir = get_repo_dir(app, bench_path=bench_path)
-		if os.path.exists(os.path.join(app_dir, '.git')):
-			remote = get_remote(app)
-			if not remote:
-				# remote is False, i.e. remote doesn't exist, add the app to excluded_apps.txt
-				add_to_excluded_apps_txt(app, bench_path=bench_path)
-				print("Skipping pull for app {}, since remote doesn't exist, and adding it to excluded apps".format(app))
-				continue
-			logger.info('pulling {0}'.format(app))
+		prefix = "[{0}] ".format(app) if jobs > 1 else None
+		start = time.time()
+
+		remote = get_remote(app, bench_path=bench_path)
+		if not remote:
+			return (app, 'skipped', "remote doesn't exist", '')
+
+		logger.info('pulling {0}'.format(app))
+		old_head = get_head_commit(app, bench_path=bench_path)
+		branch = get_current_branch(app, bench_path=bench_path)
+		fetched = prefetched.get(app)
+		failed = True
+		if fetched and (fetched['remote'], fetched['branch']) == (remote, branch):
+			# `bench update --prefetch` already fetched the commit to update to, pull only if
+			# the app can't be fast-forwarded to it
 			if reset:
-				exec_cmd("git fetch --all", cwd=app_dir)
-				exec_cmd("git reset --hard {remote}/{branch}".format(
-					remote=remote, branch=get_current_branch(app,bench_path=bench_path)), cwd=app_dir)
+				failed = exec_cmd("git reset --hard {0}".format(fetched['commit']), cwd=app_dir, prefix=prefix)
 			else:
-				exec_cmd("git pull {rebase} {remote} {branch}".format(rebase=rebase,
-					remote=remote, branch=get_current_branch(app, bench_path=bench_path)), cwd=app_dir)
-			exec_cmd('find . -name "*.pyc" -delete', cwd=app_dir)
+				failed = exec_cmd("git merge --ff-only {0}".format(fetched['commit']), cwd=app_dir, prefix=prefix)
+
+		if failed and reset:
+			failed = exec_cmd("git fetch {remote} +refs/heads/{branch}:refs/remotes/{remote}/{branch}".format(
+				remote=remote, branch=branch), cwd=app_dir, prefix=prefix) or exec_cmd("git reset --hard {remote}/{branch}".format(
+				remote=remote, branch=branch), cwd=app_dir, prefix=prefix)
+		elif failed:
+			failed = exec_cmd("git pull {rebase} {remote} {branch}".format(rebase=rebase,
+				remote=remote, branch=branch), cwd=app_dir, prefix=prefix)
+
+		new_head = get_head_commit(app, bench_path=bench_path)
+		if old_head != new_head:
+			changed_files = get_changed_files(app, old_head, new_head, bench_path=bench_path)
+			remove_stale_bytecode(app, changed_files, bench_path=bench_path)
+			changed_python_files.extend(f for f in changed_files or [] if f.endswith('.py') and os.path.exists(f))
+
+		if not failed:
+			record_update_progress('pulled_apps', app, new_head, bench_path=bench_path)
+
+		return (app, 'failed' if failed else 'pulled', '', '{0:.1f}s'.format(time.time() - start))
+
+	for app, status, reason, duration in run_parallel(pull_app, apps, jobs=jobs):
+		if reason == "remote doesn't exist":
+			# remote is False, i.e. remote doesn't exist, add the app to excluded_apps.txt
+			add_to_excluded_apps_txt(app, bench_path=bench_path)
+			print("Skipping pull for app {}, since remote doesn't exist, and adding it to excluded apps".format(app))
+		summary.append((app, status, reason, duration))
+
+	print_summary_table(('App', 'Status', 'Reason', 'Time'), summary)
+	if prefetched:
+		set_bench_state('prefetch', {}, bench_path=bench_path)
+
+	if changed_python_files:
+		# compile ahead of the restart instead of on the first requests
+		print("Compiling {0} changed Python files...".format(len(changed_python_files)))
+		compile_python_files(changed_python_files, bench_path=bench_path)
+
+	failed_apps = [row[0] for row in summary if row[1] == 'failed']
+	if failed_apps:
+		log("Pulling failed for: {0}".format(", ".join(failed_apps)), level=2)
+
+
+def prefetch_apps(bench_path='.', jobs=1):
+	"""Fetches the upstream commits of the apps' current branches without touching their working
+	trees and records them in config/prefetch.json, for the next pull to fast-forward to"""
+	from bench.utils import run_parallel, set_bench_state
+
+	excluded_apps = get_excluded_apps(bench_path=bench_path)
+	apps = [app for app in get_apps(bench_path=bench_path) if app not in excluded_apps
+		and os.path.exists(os.path.join(get_repo_dir(app, bench_path=bench_path), '.git'))]
+
+	def prefetch_app(app):
+		app_dir = get_repo_dir(app, bench_path=bench_path)
+		prefix = "[{0}] ".format(app) if jobs > 1 else None
+		remote = get_remote(app, bench_path=bench_path)
+		branch = get_current_branch(app, bench_path=bench_path)
+		if not (remote and branch):
+			return (app, None)
+
+		fetch_from_git_mirror(app, remote, bench_path=bench_path, branch=branch)
+		if exec_cmd("git fetch {remote} +refs/heads/{branch}:refs/remotes/{remote}/{branch}".format(
+			remote=remote, branch=branch), cwd=app_dir, prefix=prefix):
+			return (app, None)
+
+		commit = subprocess.check_output(['git', 'rev-parse', '{0}/{1}'.format(remote, branch)], cwd=app_dir).decode('utf-8').strip()
+		return (app, {'remote': remote, 'branch': branch, 'commit': commit, 'head': get_head_commit(app, bench_path=bench_path)})
+
+	prefetched = dict((app, fetched) for app, fetched in run_parallel(prefetch_app, apps, jobs=jobs) if fetched)
+	set_bench_state('prefetch', prefetched, bench_path=bench_path)
+	return prefetched
+
+
+def get_file_at_commit(app, commit, path, bench_path='.'):
+	"""Returns the contents of a file of the app as of the given commit, or None if it doesn't
+	exist there"""
+	try:
+		return subprocess.check_output(['git', 'show', '{0}:{1}'.format(commit, path)],
+			cwd=get_repo_dir(app, bench_path=bench_path), stderr=subprocess.STDOUT)
+	except subprocess.CalledProcessError:
+		return None
+
+
+def export_app_at_commit(app, commit, path, bench_path='.'):
+	"""Writes the app's files as of the given commit to path, without touching its working
+	tree. Returns False if git couldn't export them"""
+	import tarfile
+
+	p = subprocess.Popen(['git', 'archive', '--format=tar', commit], cwd=get_repo_dir(app, bench_path=bench_path),
+		stdout=subprocess.PIPE)
+	try:
+		with tarfile.open(fileobj=p.stdout, mode='r|') as archive:
+			archive.extractall(path)
+	except tarfile.TarError:
+		pass
+	finally:
+		p.stdout.close()
+
+	return p.wait() == 0
+
+
+def get_changed_files(app, old_head, new_head, bench_path='.'):
+	"""Returns the absolute paths of the files added, changed or removed between two commits of
+	an app, or None if git can't tell"""
+	repo_dir = os.path.abspath(get_repo_dir(app, bench_path=bench_path))
+	if not (old_head and new_head):
+		return None
+
+	try:
+		output = subprocess.check_output(['git', 'diff', '--name-only', '--no-renames', old_head, new_head],
+			cwd=repo_dir, stderr=subprocess.STDOUT)
+	except subprocess.CalledProcessError:
+		return None
+
+	return [os.path.join(repo_dir, path) for path in output.decode('utf-8').splitlines() if path]
+
+
+def remove_stale_bytecode(app, changed_files=None, bench_path='.'):
+	"""Removes the bytecode of the changed Python files, including that of removed modules which
+	Python 2 would otherwise still import. Without changed_files all of the app's bytecode is
+	removed"""
+	if changed_files is None:
+		for root, dirs, files in os.walk(get_repo_dir(app, bench_path=bench_path)):
+			dirs[:] = [d for d in dirs if d not in ('node_modules', '.git')]
+			for filename in files:
+				if filename.endswith('.pyc'):
+					os.remove(os.path.join(root, filename))
+		return
+
+	for path in changed_files:
+		if not path.endswith('.py'):
+			continue
+		directory, filename = os.path.split(path)
+		bytecode = [path + 'c'] + glob.glob(os.path.join(directory, '__pycache__', filename[:-len('.py')] + '.*.pyc'))
+		for pyc in bytecode:
+			if os.path.exists(pyc):
+				os.remove(pyc)
 
 
 def is_version_upgrade(app='frappe', bench_path='.', branch=None):
 	try:
-		fetch_upstream(app, bench_path=bench_path)
+		fetch_upstream(app, bench_path=bench_path, branch=branch)
 	except CommandFailedError:
 		raise InvalidRemoteException("No remote named upstream for {0}".format(app))
 
@@ -297,30 +476,36 @@ def get_current_frappe_version(bench_path='.'):
 		return 0
 
 def get_current_branch(app, bench_path='.'):
+	branch = get_git_metadata(app, bench_path=bench_path)['branch']
+	if branch:
+		return branch
+
+	# detached HEAD
 	repo_dir = get_repo_dir(app, bench_path=bench_path)
 	return get_cmd_output("basename $(git symbolic-ref -q HEAD)", cwd=repo_dir)
 
 def get_remote(app, bench_path='.'):
-	repo_dir = get_repo_dir(app, bench_path=bench_path)
-	contents = subprocess.check_output(['git', 'remote', '-v'], cwd=repo_dir, stderr=subprocess.STDOUT)
-	contents = contents.decode('utf-8')
-	if re.findall('upstream[\s]+', contents):
+	remotes = get_git_metadata(app, bench_path=bench_path)['remotes']
+	if 'upstream' in remotes:
 		return 'upstream'
-	elif not contents:
-		# if contents is an empty string => remote doesn't exist
+	elif not remotes:
+		# remote doesn't exist
 		return False
 	else:
 		# get the first remote
-		return contents.splitlines()[0].split()[0]
+		return list(remotes)[0]
 
 def use_rq(bench_path):
 	bench_path = os.path.abspath(bench_path)
 	celery_app = os.path.join(bench_path, 'apps', 'frappe', 'frappe', 'celery_app.py')
 	return not os.path.exists(celery_app)
 
-def fetch_upstream(app, bench_path='.'):
+def fetch_upstream(app, bench_path='.', branch=None):
+	"""Fetches the given branch, the current one by default, from upstream"""
 	repo_dir = get_repo_dir(app, bench_path=bench_path)
-	return subprocess.call(["git", "fetch", "upstream"], cwd=repo_dir)
+	branch = branch or get_current_branch(app, bench_path=bench_path)
+	refspec = ["+refs/heads/{0}:refs/remotes/upstream/{0}".format(branch)] if branch else []
+	return subprocess.call(["git", "fetch", "upstream"] + refspec, cwd=repo_dir)
 
 def get_current_version(app, bench_path='.'):
 	repo_dir = get_repo_dir(app, bench_path=bench_path)
@@ -353,12 +538,165 @@ def get_upstream_version(app, branch=None, bench_path='.'):
 	return get_version_from_string(contents)
 
 def get_upstream_url(app, bench_path='.'):
-	repo_dir = get_repo_dir(app, bench_path=bench_path)
-	return subprocess.check_output(['git', 'config', '--get', 'remote.upstream.url'], cwd=repo_dir).strip()
+	return get_remote_url(app, 'upstream', bench_path=bench_path)
+
+def get_remote_url(app, remote, bench_path='.'):
+	return get_git_metadata(app, bench_path=bench_path)['remotes'].get(remote)
+
+def get_git_cache_path(bench_path='.'):
+	"""Returns the directory of the bare mirrors shared by the benches on this host, or None if
+	the git cache isn't enabled with `git_cache` in common_site_config or BENCH_GIT_CACHE"""
+	git_cache = get_config(bench_path=bench_path).get('git_cache') or os.environ.get('BENCH_GIT_CACHE')
+	if not git_cache:
+		return None
+
+	if git_cache is True:
+		git_cache = os.path.join('~', '.bench', 'git-cache')
+	return os.path.abspath(os.path.expanduser(git_cache))
+
+def get_git_mirror(git_url, bench_path='.'):
+	"""Returns the git cache's bare mirror of git_url, cloning it the first time and fetching into
+	it once per bench run. Returns None if the git cache is disabled, git_url is a local
+	repository or the mirror couldn't be set up"""
+	git_cache = get_git_cache_path(bench_path=bench_path)
+	if not git_cache or not git_url or os.path.exists(git_url):
+		return None
+
+	# https://github.com/frappe/erpnext.git and git@github.com:frappe/erpnext map to frappe/erpnext.git
+	org, repo = re.split(r'[/:]', re.sub(r'\.git$', '', git_url.rstrip('/')))[-2:]
+	git_mirror = os.path.join(git_cache, org, repo + '.git')
+
+	if git_mirror in refreshed_git_mirrors:
+		return git_mirror
+
+	makedirs_safe(os.path.dirname(git_mirror))
+
+	with file_lock(git_mirror + '.lock'):
+		if os.path.isdir(git_mirror):
+			return_code = exec_cmd("git fetch --prune origin", cwd=git_mirror)
+		else:
+			return_code = exec_cmd("git clone --mirror {0} {1}".format(git_url, git_mirror), cwd=git_cache)
+
+	if return_code:
+		bench.utils.log("Could not update the git cache for {0}".format(git_url), level=3)
+		if not os.path.isdir(git_mirror):
+			return None
+
+	refreshed_git_mirrors.add(git_mirror)
+	return git_mirror
+
+def fetch_from_git_mirror(app, remote, bench_path='.', branch=None, depth=None):
+	"""Fetches the remote's branches, or just the given one, into the app from the git cache, so
+	that fetching from the remote afterwards only transfers what the cache doesn't have yet"""
+	git_mirror = get_git_mirror(get_remote_url(app, remote, bench_path=bench_path), bench_path=bench_path)
+	if git_mirror:
+		exec_cmd("git fetch {depth} {git_mirror} +refs/heads/{branch}:refs/remotes/{remote}/{branch}".format(
+			depth="--depth {0}".format(depth) if depth else "", git_mirror=git_mirror, branch=branch or "*", remote=remote),
+			cwd=get_repo_dir(app, bench_path=bench_path))
 
 def get_repo_dir(app, bench_path='.'):
 	return os.path.join(bench_path, 'apps', app)
 
+def get_head_commit(app, bench_path='.'):
+	return get_git_metadata(app, bench_path=bench_path)['head']
+
+def get_git_metadata(app, bench_path='.'):
+	"""Returns the current branch, HEAD commit and remotes of an app's repository.
+
+	The metadata is read from .git directly, falling back to GitPython for layouts the reader
+	doesn't handle, and is cached for the rest of the bench run. exec_cmd clears the cache for
+	a repository whenever bench runs a git command in it."""
+	repo_dir = os.path.abspath(get_repo_dir(app, bench_path=bench_path))
+
+	if repo_dir not in git_metadata_cache:
+		if not os.path.exists(os.path.join(repo_dir, '.git')):
+			metadata = {'branch': None, 'head': None, 'remotes': OrderedDict()}
+		else:
+			try:
+				metadata = read_git_metadata(repo_dir)
+			except (IOError, OSError, ValueError):
+				metadata = read_git_metadata_with_gitpython(repo_dir)
+		git_metadata_cache[repo_dir] = metadata
+
+	return git_metadata_cache[repo_dir]
+
+def clear_git_metadata_cache(repo_dir=None):
+	if repo_dir:
+		git_metadata_cache.pop(os.path.abspath(repo_dir), None)
+	else:
+		git_metadata_cache.clear()
+
+def read_git_metadata(repo_dir):
+	git_dir = os.path.join(repo_dir, '.git')
+	if not os.path.isdir(git_dir):
+		# worktrees and submodules have a .git file pointing elsewhere
+		raise ValueError("{0} is not a git directory".format(git_dir))
+
+	with open(os.path.join(git_dir, 'HEAD')) as f:
+		head = f.read().strip()
+
+	branch = None
+	if head.startswith('ref:'):
+		ref = head.split(':', 1)[1].strip()
+		if ref.startswith('refs/heads/'):
+			branch = ref[len('refs/heads/'):]
+		head = resolve_git_ref(git_dir, ref)
+
+	remotes = OrderedDict()
+	remote = None
+	with open(os.path.join(git_dir, 'config')) as f:
+		for line in f:
+			line = line.strip()
+			if not line or line[0] in '#;':
+				continue
+
+			if line.startswith('['):
+				match = re.match(r'\[remote\s+"(.+)"\]', line)
+				remote = match.group(1) if match else None
+				if remote:
+					remotes.setdefault(remote, None)
+
+			elif remote and '=' in line:
+				key, value = line.split('=', 1)
+				if key.strip().lower() == 'url':
+					remotes[remote] = value.strip()
+
+	return {'branch': branch, 'head': head, 'remotes': remotes}
+
+def resolve_git_ref(git_dir, ref):
+	try:
+		with open(os.path.join(git_dir, ref)) as f:
+			return f.read().strip()
+	except IOError:
+		pass
+
+	try:
+		with open(os.path.join(git_dir, 'packed-refs')) as f:
+			for line in f:
+				parts = line.strip().split(' ', 1)
+				if len(parts) == 2 and parts[1] == ref:
+					return parts[0]
+	except IOError:
+		pass
+
+	# unborn branch
+	return None
+
+def read_git_metadata_with_gitpython(repo_dir):
+	import git
+
+	repo = git.Repo(repo_dir)
+	try:
+		head = repo.head.commit.hexsha
+	except ValueError:
+		head = None
+
+	return {
+		'branch': None if repo.head.is_detached else repo.active_branch.name,
+		'head': head,
+		'remotes': OrderedDict((remote.name, remote.url) for remote in repo.remotes)
+	}
+
 def switch_branch(branch, apps=None, bench_path='.', upgrade=False, check_upgrade=True):
 	from bench.utils import update_requirements, update_node_packages, backup_all_sites, patch_sites, build_assets, post_upgrade
 	apps_dir = os.path.join(bench_path, 'apps')
@@ -378,12 +716,14 @@ def switch_branch(branch, apps=None, bench_path='.', upgrade=False, check_upgrad
 			bench.utils.log("{} does not exist!".format(app), level=2)
 			continue
 
-		repo = git.Repo(app_dir)
-		unshallow_flag = os.path.exists(os.path.join(app_dir, ".git", "shallow"))
-		bench.utils.log("Fetching upstream {0}for {1}".format("unshallow " if unshallow_flag else "", app))
+		# fetch only the branch being switched to, shallow clones stay shallow
+		depth = 1 if os.path.exists(os.path.join(app_dir, ".git", "shallow")) else None
+		bench.utils.log("Fetching {0} from upstream for {1}".format(branch, app))
 
-		bench.utils.exec_cmd("git remote set-branches upstream  '*'", cwd=app_dir)
-		bench.utils.exec_cmd("git fetch --all{0}".format(" --unshallow" if unshallow_flag else ""), cwd=app_dir)
+		bench.utils.exec_cmd("git remote set-branches --add upstream {0}".format(branch), cwd=app_dir)
+		fetch_from_git_mirror(app, 'upstream', bench_path=bench_path, branch=branch, depth=depth)
+		bench.utils.exec_cmd("git fetch {0} upstream +refs/heads/{1}:refs/remotes/upstream/{1}".format(
+			"--depth {0}".format(depth) if depth else "", branch), cwd=app_dir)
 
 		if check_upgrade:
 			version_upgrade = is_version_upgrade(app=app, bench_path=bench_path, branch=branch)
@@ -394,7 +734,7 @@ def switch_branch(branch, apps=None, bench_path='.', upgrade=False, check_upgrad
 		print("Switching for "+app)
 		bench.utils.exec_cmd("git checkout {0}".format(branch), cwd=app_dir)
 
-		if str(repo.active_branch) == branch:
+		if get_current_branch(app, bench_path=bench_path) == branch:
 			switched_apps.append(app)
 		else:
 			bench.utils.log("Switching branches failed for: {}".format(app), level=2)
@@ -427,6 +767,7 @@ def get_version_from_string(contents, field='__version__'):
 	return match.group(2)
 
 def get_major_version(version):
+	import semantic_version
 	return semantic_version.Version(version).major
 
 def install_apps_from_path(path, bench_path='.'):
@@ -436,6 +777,7 @@ def install_apps_from_path(path, bench_path='.'):
 
 def get_apps_json(path):
 	if path.startswith('http'):
+		import requests
 		r = requests.get(path)
 		return r.json()
 
@@ -1,7 +1,6 @@
 import click
-import os, sys, logging, json, pwd, subprocess
-from bench.utils import is_root, PatchError, drop_privileges, get_env_cmd, get_cmd_output, get_frappe, log, find_parent_bench
-from bench.app import get_apps
+import os, sys, logging, json, pwd, subprocess, hashlib, glob
+from bench.utils import is_root, PatchError, drop_privileges, get_env_cmd, get_cmd_output, get_frappe, log, find_parent_bench, get_bench_state, set_bench_state, run_on_helper_server
 from bench.config.common_site_config import get_config
 from bench.commands import bench_command
 
@@ -32,10 +31,13 @@ def cli():
 		print(get_frappe_help())
 		return
 
-	elif len(sys.argv) > 1 and sys.argv[1] in get_apps():
-		return app_cmd()
-
 	else:
+		# imported here so that frappe commands don't load bench.app
+		from bench.app import get_apps
+
+		if len(sys.argv) > 1 and sys.argv[1] in get_apps():
+			return app_cmd()
+
 		try:
 			# NOTE: this is the main bench command
 			bench_command()
@@ -81,37 +83,118 @@ def old_frappe_cli(bench_path='.'):
 	os.execv(f, [f] + sys.argv[2:])
 
 def app_cmd(bench_path='.'):
-	f = get_env_cmd('python', bench_path=bench_path)
-	os.chdir(os.path.join(bench_path, 'sites'))
-	os.execv(f, [f] + ['-m', 'frappe.utils.bench_helper'] + sys.argv[1:])
+	exec_bench_helper(sys.argv[1:], bench_path=bench_path)
 
 def frappe_cmd(bench_path='.'):
+	exec_bench_helper(['frappe'] + sys.argv[1:], bench_path=bench_path)
+
+def exec_bench_helper(args, bench_path='.'):
+	"""Runs frappe's bench_helper on the helper server if one is running, else execs into it"""
+	return_code = run_on_helper_server(args, bench_path=bench_path)
+	if return_code is not None:
+		# mimic the shell's exit status for commands killed by a signal
+		sys.exit(return_code if return_code >= 0 else 128 - return_code)
+
 	f = get_env_cmd('python', bench_path=bench_path)
 	os.chdir(os.path.join(bench_path, 'sites'))
-	os.execv(f, [f] + ['-m', 'frappe.utils.bench_helper', 'frappe'] + sys.argv[1:])
+	os.execv(f, [f] + ['-m', 'frappe.utils.bench_helper'] + args)
 
 def get_frappe_commands(bench_path='.'):
-	python = get_env_cmd('python', bench_path=bench_path)
 	sites_path = os.path.join(bench_path, 'sites')
 	if not os.path.exists(sites_path):
 		log("Command not being executed in bench directory", level=3)
 		return []
+	return get_frappe_command_index(bench_path=bench_path).get('commands', [])
+
+def get_frappe_help(bench_path='.'):
+	index = get_frappe_command_index(bench_path=bench_path)
+	if not index:
+		return ""
+
+	if 'help' not in index:
+		python = get_env_cmd('python', bench_path=bench_path)
+		sites_path = os.path.join(bench_path, 'sites')
+		try:
+			out = get_cmd_output("{python} -m frappe.utils.bench_helper get-frappe-help".format(python=python), cwd=sites_path)
+			index['help'] = out.split('Commands:')[1]
+		except:
+			return ""
+		set_bench_state('frappe_commands', index, bench_path=bench_path)
+
+	return "\n\nFramework commands:\n" + index['help']
+
+def get_frappe_command_index(bench_path='.'):
+	"""Returns the frappe command index stored in config/frappe_commands.json. The index is
+	rebuilt only when the installed apps, their checked out commits or the env change"""
+	sites_path = os.path.join(bench_path, 'sites')
+	if not os.path.exists(sites_path):
+		return {}
+
+	key = get_command_index_key(bench_path=bench_path)
+	index = get_bench_state('frappe_commands', bench_path=bench_path)
+	if index.get('key') == key:
+		return index
+
+	python = get_env_cmd('python', bench_path=bench_path)
 	try:
 		output = get_cmd_output("{python} -m frappe.utils.bench_helper get-frappe-commands".format(python=python), cwd=sites_path)
-		return json.loads(output)
+		index = {'key': key, 'commands': json.loads(output)}
 	except subprocess.CalledProcessError as e:
 		if hasattr(e, "stderr"):
 			print(e.stderr.decode('utf-8'))
-		return []
+		return {}
+	except OSError:
+		return {}
 
-def get_frappe_help(bench_path='.'):
-	python = get_env_cmd('python', bench_path=bench_path)
-	sites_path = os.path.join(bench_path, 'sites')
+	set_bench_state('frappe_commands', index, bench_path=bench_path)
+	return index
+
+def get_command_index_key(bench_path='.'):
 	try:
-		out = get_cmd_output("{python} -m frappe.utils.bench_helper get-frappe-help".format(python=python), cwd=sites_path)
-		return "\n\nFramework commands:\n" + out.split('Commands:')[1]
-	except:
-		return ""
+		with open(os.path.join(bench_path, 'sites', 'apps.txt')) as f:
+			apps_txt = f.read().strip()
+	except IOError:
+		apps_txt = ''
+
+	state = [apps_txt]
+	for app in apps_txt.split('\n'):
+		app_path = os.path.join(bench_path, 'apps', app)
+		# apps that aren't git checkouts are keyed on the mtime of their package directory
+		state.append(get_head_state(app_path) or get_mtime(os.path.join(app_path, app)))
+		# uncommitted changes to the app's commands
+		state.append([get_mtime(path) for path in sorted(glob.glob(os.path.join(app_path, app, 'commands.py'))
+			+ glob.glob(os.path.join(app_path, app, 'commands', '*.py')))])
+	state.append(get_mtime(get_env_cmd('python', bench_path=bench_path)))
+	# packages installed into or removed from env add or remove entries in site-packages
+	state.append([get_mtime(path) for path in sorted(glob.glob(os.path.join(bench_path, 'env', 'lib', 'python*', 'site-packages')))])
+
+	return hashlib.sha1(json.dumps(state).encode('utf-8')).hexdigest()
+
+def get_head_state(app_path):
+	"""Identifies the commit checked out in app_path without bench.app, which every frappe command
+	would otherwise import: the HEAD file, along with the branch ref it points to"""
+	git_dir = os.path.join(app_path, '.git')
+	try:
+		with open(os.path.join(git_dir, 'HEAD')) as f:
+			head = f.read().strip()
+	except (IOError, OSError):
+		return None
+
+	if not head.startswith('ref:'):
+		return head
+
+	try:
+		with open(os.path.join(git_dir, head.split(':', 1)[1].strip())) as f:
+			return [head, f.read().strip()]
+	except (IOError, OSError):
+		# the branch is only in packed-refs
+		return [head, get_mtime(os.path.join(git_dir, 'packed-refs'))]
+
+def get_mtime(path):
+	try:
+		return os.lstat(path).st_mtime
+	except OSError:
+		return None
 
 def change_working_directory():
 	"""Allows bench commands to be run from anywhere inside a bench directory"""
@@ -1,3 +1,9 @@
+# imports - standard imports
+import importlib
+import subprocess
+import sys
+
+# imports - third party imports
 import click
 
 
@@ -10,8 +16,118 @@ def print_bench_version(ctx, param, value):
 	click.echo(bench.__version__)
 	ctx.exit()
 
-@click.group()
+
+def print_startup_profile(ctx, param, value):
+	"""Prints the modules bench imports before dispatching a command, most expensive first"""
+	if not value or ctx.resilient_parsing:
+		return
+
+	if sys.version_info < (3, 7):
+		click.echo("--profile-startup requires Python 3.7 or above")
+		ctx.exit(1)
+
+	args = [arg for arg in sys.argv[1:] if not arg.startswith('-')]
+	command = args[0] if args else None
+
+	# profile a fresh interpreter, the current one has already imported everything
+	script = "import bench.cli; bench.cli.bench_command.get_command(None, {0!r})".format(command)
+	p = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', script], stdout=subprocess.PIPE,
+		stderr=subprocess.PIPE, universal_newlines=True)
+	_, err = p.communicate()
+
+	imports = []
+	for line in err.splitlines():
+		# import time: self [us] | cumulative | imported package
+		if not line.startswith('import time:') or 'imported package' in line:
+			continue
+		self_us, cumulative_us, module = line[len('import time:'):].split('|')
+		imports.append((int(self_us), int(cumulative_us), module.strip()))
+
+	click.echo("Startup imports for `bench {0}`:".format(command or ''))
+	click.echo("{0:>10} {1:>12}  {2}".format("self (ms)", "total (ms)", "module"))
+	for self_us, cumulative_us, module in sorted(imports, reverse=True)[:25]:
+		click.echo("{0:>10.1f} {1:>12.1f}  {2}".format(self_us / 1000.0, cumulative_us / 1000.0, module))
+	click.echo("Total import time: {0:.1f} ms across {1} modules".format(sum(i[0] for i in imports) / 1000.0, len(imports)))
+	ctx.exit()
+
+
+class LazyCommandGroup(click.Group):
+	"""Click group that imports a subcommand's module only when the subcommand is dispatched"""
+	def __init__(self, *args, **kwargs):
+		self.lazy_commands = kwargs.pop('lazy_commands', {})
+		super(LazyCommandGroup, self).__init__(*args, **kwargs)
+
+	def list_commands(self, ctx):
+		return sorted(set(self.commands) | set(self.lazy_commands))
+
+	def get_command(self, ctx, cmd_name):
+		if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+			module_name, attr = self.lazy_commands[cmd_name].rsplit('.', 1)
+			module = importlib.import_module(module_name)
+			self.add_command(getattr(module, attr), name=cmd_name)
+		return self.commands.get(cmd_name)
+
+
+# command name: dotted path of the click command implementing it
+bench_commands = {
+	'init': 'bench.commands.make.init',
+	'get-app': 'bench.commands.make.get_app',
+	'new-app': 'bench.commands.make.new_app',
+	'remove-app': 'bench.commands.make.remove_app',
+	'exclude-app': 'bench.commands.make.exclude_app_for_update',
+	'include-app': 'bench.commands.make.include_app_for_update',
+	'pip': 'bench.commands.make.pip',
+
+	'update': 'bench.commands.update.update',
+	'retry-upgrade': 'bench.commands.update.retry_upgrade',
+	'rollback': 'bench.commands.update.rollback',
+	'switch-to-branch': 'bench.commands.update.switch_to_branch',
+	'switch-to-master': 'bench.commands.update.switch_to_master',
+	'switch-to-develop': 'bench.commands.update.switch_to_develop',
+
+	'start': 'bench.commands.utils.start',
+	'restart': 'bench.commands.utils.restart',
+	'set-nginx-port': 'bench.commands.utils.set_nginx_port',
+	'set-ssl-certificate': 'bench.commands.utils.set_ssl_certificate',
+	'set-ssl-key': 'bench.commands.utils.set_ssl_certificate_key',
+	'set-url-root': 'bench.commands.utils.set_url_root',
+	'set-mariadb-host': 'bench.commands.utils.set_mariadb_host',
+	'set-redis-cache-host': 'bench.commands.utils.set_redis_cache_host',
+	'set-redis-queue-host': 'bench.commands.utils.set_redis_queue_host',
+	'set-redis-socketio-host': 'bench.commands.utils.set_redis_socketio_host',
+	'set-default-site': 'bench.commands.utils.set_default_site',
+	'download-translations': 'bench.commands.utils.download_translations',
+	'backup': 'bench.commands.utils.backup_site',
+	'backup-all-sites': 'bench.commands.utils.backup_all_sites',
+	'release': 'bench.commands.utils.release',
+	'renew-lets-encrypt': 'bench.commands.utils.renew_lets_encrypt',
+	'disable-production': 'bench.commands.utils.disable_production',
+	'src': 'bench.commands.utils.bench_src',
+	'prepare-beta-release': 'bench.commands.utils.prepare_beta_release',
+	'find': 'bench.commands.utils.find_benches',
+	'migrate-env': 'bench.commands.utils.migrate_env',
+
+	'setup': 'bench.commands.setup.setup',
+
+	'config': 'bench.commands.config.config',
+
+	'remote-set-url': 'bench.commands.git.remote_set_url',
+	'remote-reset-url': 'bench.commands.git.remote_reset_url',
+	'remote-urls': 'bench.commands.git.remote_urls',
+
+	'install': 'bench.commands.install.install',
+
+	'helper-server': 'bench.commands.helper_server.helper_server',
+	'wheelhouse': 'bench.commands.wheelhouse.wheelhouse',
+	'deployments': 'bench.commands.deployments.deployments',
+	'ports': 'bench.commands.ports.ports',
+}
+
+
+@click.group(cls=LazyCommandGroup, lazy_commands=bench_commands)
 @click.option('--version', is_flag=True, is_eager=True, callback=print_bench_version, expose_value=False)
+@click.option('--profile-startup', is_flag=True, is_eager=True, callback=print_startup_profile, expose_value=False,
+	help="Report the import time of bench modules for the given command instead of running it")
 def bench_command(bench_path='.'):
 	"""Bench manager for Frappe"""
 	import bench
@@ -19,63 +135,3 @@ def bench_command(bench_path='.'):
 
 	bench.set_frappe_version(bench_path=bench_path)
 	setup_logging(bench_path=bench_path)
-
-
-from bench.commands.make import init, get_app, new_app, remove_app, exclude_app_for_update, include_app_for_update, pip
-bench_command.add_command(init)
-bench_command.add_command(get_app)
-bench_command.add_command(new_app)
-bench_command.add_command(remove_app)
-bench_command.add_command(exclude_app_for_update)
-bench_command.add_command(include_app_for_update)
-bench_command.add_command(pip)
-
-
-from bench.commands.update import update, retry_upgrade, switch_to_branch, switch_to_master, switch_to_develop
-bench_command.add_command(update)
-bench_command.add_command(retry_upgrade)
-bench_command.add_command(switch_to_branch)
-bench_command.add_command(switch_to_master)
-bench_command.add_command(switch_to_develop)
-
-
-from bench.commands.utils import (start, restart, set_nginx_port, set_ssl_certificate, set_ssl_certificate_key, set_url_root,
-	set_mariadb_host, set_default_site, download_translations, backup_site, backup_all_sites, release, renew_lets_encrypt,
-	disable_production, bench_src, prepare_beta_release, set_redis_cache_host, set_redis_queue_host, set_redis_socketio_host, find_benches, migrate_env)
-bench_command.add_command(start)
-bench_command.add_command(restart)
-bench_command.add_command(set_nginx_port)
-bench_command.add_command(set_ssl_certificate)
-bench_command.add_command(set_ssl_certificate_key)
-bench_command.add_command(set_url_root)
-bench_command.add_command(set_mariadb_host)
-bench_command.add_command(set_redis_cache_host)
-bench_command.add_command(set_redis_queue_host)
-bench_command.add_command(set_redis_socketio_host)
-bench_command.add_command(set_default_site)
-bench_command.add_command(download_translations)
-bench_command.add_command(backup_site)
-bench_command.add_command(backup_all_sites)
-bench_command.add_command(release)
-bench_command.add_command(renew_lets_encrypt)
-bench_command.add_command(disable_production)
-bench_command.add_command(bench_src)
-bench_command.add_command(prepare_beta_release)
-bench_command.add_command(find_benches)
-bench_command.add_command(migrate_env)
-
-
-from bench.commands.setup import setup
-bench_command.add_command(setup)
-
-
-from bench.commands.config import config
-bench_command.add_command(config)
-
-from bench.commands.git import remote_set_url, remote_reset_url, remote_urls
-bench_command.add_command(remote_set_url)
-bench_command.add_command(remote_reset_url)
-bench_command.add_command(remote_urls)
-
-from bench.commands.install import install
-bench_command.add_command(install)
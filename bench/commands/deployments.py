@@ -0,0 +1,50 @@
+# imports - standard imports
+import sys
+
+# imports - third party imports
+import click
+
+
+@click.group('deployments', help="Manage the releases created by `bench update --staged`")
+def deployments():
+	pass
+
+
+@click.command('list', help="List the releases, most recently active first")
+def list_releases():
+	from bench.deployments import print_releases
+	print_releases(bench_path='.')
+
+
+@click.command('rollback', help="Switch back to the previously active release, or to the given release. Site migrations aren't rolled back")
+@click.argument('release', required=False)
+def rollback_release(release):
+	from bench.config.common_site_config import get_config
+	from bench.deployments import rollback
+	from bench.utils import (get_bench_state, is_process_running, restart_supervisor_processes,
+		restart_systemd_processes, start_helper_server, stop_helper_server)
+
+	if not rollback(release=release, bench_path='.'):
+		sys.exit(1)
+
+	conf = get_config('.')
+	if conf.get('restart_supervisor_on_update'):
+		restart_supervisor_processes(bench_path='.')
+	if conf.get('restart_systemd_on_update'):
+		restart_systemd_processes(bench_path='.')
+
+	if is_process_running(get_bench_state('helper_server', bench_path='.').get('pid')):
+		stop_helper_server(bench_path='.')
+		start_helper_server(bench_path='.')
+
+
+@click.command('prune', help="Remove all but the most recently active releases")
+@click.option('--keep', type=int, default=3, help="Number of releases to keep, including the current one")
+def prune_releases(keep):
+	from bench.deployments import prune_releases
+	prune_releases(bench_path='.', keep=keep)
+
+
+deployments.add_command(list_releases)
+deployments.add_command(rollback_release)
+deployments.add_command(prune_releases)
@@ -0,0 +1,46 @@
+# imports - third party imports
+import click
+
+
+@click.group('helper-server', help="Manage the helper server that preloads frappe to run frappe commands without cold starts")
+def helper_server():
+	pass
+
+
+@click.command('start', help="Start the helper server for this bench")
+@click.option('--foreground', is_flag=True, default=False, help="Run the server in the foreground, for process managers")
+def start_helper_server(foreground=False):
+	from bench.utils import start_helper_server
+	start_helper_server(bench_path='.', foreground=foreground)
+
+
+@click.command('stop', help="Stop the helper server for this bench")
+def stop_helper_server():
+	from bench.utils import stop_helper_server
+	stop_helper_server(bench_path='.')
+
+
+@click.command('restart', help="Restart the helper server, reloading frappe and the apps")
+def restart_helper_server():
+	from bench.utils import start_helper_server, stop_helper_server
+	stop_helper_server(bench_path='.')
+	start_helper_server(bench_path='.')
+
+
+@click.command('status', help="Show whether the helper server is running and serving requests")
+def helper_server_status():
+	from bench.utils import get_bench_state, get_helper_server_socket, is_process_running
+	pid = get_bench_state('helper_server', bench_path='.').get('pid')
+
+	if not is_process_running(pid):
+		print("Helper server is not running")
+	elif get_helper_server_socket(bench_path='.'):
+		print("Helper server is running with pid {0}".format(pid))
+	else:
+		print("Helper server with pid {0} is running but not serving requests".format(pid))
+
+
+helper_server.add_command(start_helper_server)
+helper_server.add_command(stop_helper_server)
+helper_server.add_command(restart_helper_server)
+helper_server.add_command(helper_server_status)
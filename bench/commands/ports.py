@@ -0,0 +1,34 @@
+# imports - third party imports
+import click
+
+
+@click.group('ports', help="Manage the ports allocated to the benches on this host")
+def ports():
+	pass
+
+
+@click.command('show', help="List the ports allocated to each bench, and the ports more than one bench uses")
+def show_ports():
+	from bench.config.ports import print_ports
+	print_ports()
+
+
+@click.command('repair', help="Release the ports of benches missing for over a week, reread the ports of the benches from their common_site_config and reallocate the ports this bench shares with another bench")
+def repair_ports():
+	from bench.config.ports import print_ports, repair_ports
+	repair_ports(bench_path='.')
+	print_ports()
+
+
+@click.command('free', help="Release the ports of this bench before removing it, or of the bench at BENCH_PATH once it has been removed")
+@click.argument('bench_path', required=False, default='.')
+def free_ports(bench_path):
+	from bench.config.ports import free_ports
+	from bench.utils import log
+	if not free_ports(bench_path=bench_path):
+		log("No ports are allocated to {0}".format(bench_path), level=3)
+
+
+ports.add_command(show_ports)
+ports.add_command(repair_ports)
+ports.add_command(free_ports)
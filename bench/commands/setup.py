@@ -146,14 +146,15 @@ def setup_socketio():
 @click.command("requirements", help="Setup Python and Node dependencies")
 @click.option("--node", help="Update only Node packages", default=False, is_flag=True)
 @click.option("--python", help="Update only Python packages", default=False, is_flag=True)
-def setup_requirements(node=False, python=False):
+@click.option("--force", help="Reinstall the packages of all apps, including those whose requirements haven't changed", default=False, is_flag=True)
+def setup_requirements(node=False, python=False, force=False):
 	if not node:
 		from bench.utils import update_requirements as setup_python_packages
-		setup_python_packages()
+		setup_python_packages(force=force)
 
 	if not python:
 		from bench.utils import update_node_packages as setup_node_packages
-		setup_node_packages()
+		setup_node_packages(force=force)
 
 
 @click.command("manager", help="Setup bench-manager.local site with the bench_manager app installed on it")
@@ -1,13 +1,8 @@
 # imports - standard imports
-import os
+import sys
 
 # imports - third party imports
 import click
-from six.moves import reload_module
-
-# imports - module imports
-from bench.app import pull_all_apps
-from bench.utils import post_upgrade, patch_sites, build_assets
 
 
 @click.command('update', help="Updates bench tool and if executed in a bench directory, without any flags will backup, pull, setup requirements, build, run patches and restart bench. Using specific flags will only do certain tasks instead of all")
@@ -20,20 +15,45 @@ from bench.utils import post_upgrade, patch_sites, build_assets
 @click.option('--no-backup', is_flag=True, help="If this flag is set, sites won't be backed up prior to updates. Note: This is not recommended in production.")
 @click.option('--force', is_flag=True, help="Forces major version upgrades")
 @click.option('--reset', is_flag=True, help="Hard resets git branch's to their new states overriding any changes and overriding rebase on pull")
-def update(pull, patch, build, requirements, restart_supervisor, restart_systemd, no_backup, force, reset):
+@click.option('--jobs', '-j', type=int, help="Number of apps to pull and sites to back up or migrate in parallel")
+@click.option('--migrate-all', is_flag=True, help="Migrate every site, including those whose installed apps haven't changed since their last migration")
+@click.option('--prefetch', is_flag=True, help="Only fetch app updates and download the Python and Node packages they need, without applying anything. The next update applies them without going to the network")
+@click.option('--rolling', is_flag=True, help="Keep the sites up during the update, putting each site in maintenance mode only while it is migrated")
+@click.option('--wave-size', type=int, help="Number of sites migrated, and so in maintenance mode, at a time with --rolling")
+@click.option('--staged', is_flag=True, help="Update and build a copy of the apps with a fresh env while the bench keeps running, then migrate and switch over to it")
+@click.option('--resume', is_flag=True, help="Continue an update that didn't finish with its options, skipping the stages, apps and sites it completed")
+def update(pull, patch, build, requirements, restart_supervisor, restart_systemd, no_backup, force, reset, jobs, migrate_all, prefetch, rolling, wave_size, staged, resume):
 	from bench.utils import update
-	update(pull=pull, patch=patch, build=build, requirements=requirements, restart_supervisor=restart_supervisor, restart_systemd=restart_systemd, backup=not no_backup, force=force, reset=reset)
+	update(pull=pull, patch=patch, build=build, requirements=requirements, restart_supervisor=restart_supervisor, restart_systemd=restart_systemd, backup=not no_backup, force=force, reset=reset, jobs=jobs, migrate_all=migrate_all, prefetch=prefetch, rolling=rolling, wave_size=wave_size, staged=staged, resume=resume)
 
 
 @click.command('retry-upgrade', help="Retry a failed upgrade")
 @click.option('--version', default=5)
 def retry_upgrade(version):
+	from bench.app import pull_all_apps
+	from bench.utils import build_assets, get_bench_state, patch_sites, post_upgrade, update
+
+	if get_bench_state('update_journal', bench_path='.'):
+		# continue where the failed upgrade stopped
+		update(resume=True)
+		return
+
 	pull_all_apps()
 	patch_sites()
 	build_assets()
 	post_upgrade(version-1, version)
 
 
+@click.command('rollback', help="Restore the apps, Python packages and assets to what they were before the last update")
+@click.option('--restore-sites', is_flag=True, help="Also restore the sites the update migrated from the backups it took")
+@click.option('--mariadb-root-password', help="MariaDB root password, needed to restore sites")
+@click.option('--jobs', '-j', type=int, help="Number of apps to restore in parallel")
+def rollback(restore_sites, mariadb_root_password, jobs):
+	from bench.utils import rollback_update
+	if not rollback_update(bench_path='.', restore_sites=restore_sites, mariadb_root_password=mariadb_root_password, jobs=jobs):
+		sys.exit(1)
+
+
 @click.command('switch-to-branch', help="Switch all apps to specified branch, or specify apps separated by space")
 @click.argument('branch')
 @click.argument('apps', nargs=-1)
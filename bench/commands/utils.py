@@ -127,9 +127,11 @@ def backup_site(site):
 
 
 @click.command('backup-all-sites', help="Backup all sites in current bench")
-def backup_all_sites():
+@click.option('--jobs', '-j', type=int, help="Number of sites to back up in parallel")
+@click.option('--max-load', type=float, help="Wait for the 1 minute load average to drop below this before starting each backup")
+def backup_all_sites(jobs=None, max_load=None):
 	from bench.utils import backup_all_sites
-	backup_all_sites(bench_path='.')
+	backup_all_sites(bench_path='.', jobs=jobs, max_load=max_load)
 
 
 @click.command('release', help="Release a Frappe app (internal to the Frappe team)")
@@ -0,0 +1,29 @@
+# imports - standard imports
+import sys
+
+# imports - third party imports
+import click
+
+
+@click.group('wheelhouse', help="Manage the prebuilt wheels shared by the benches on this host")
+def wheelhouse():
+	pass
+
+
+@click.command('build', help="Build wheels for the requirements of the bench's apps, or of the given apps, into the wheelhouse")
+@click.argument('apps', nargs=-1)
+def build_wheelhouse(apps):
+	from bench.utils import build_wheelhouse
+	if build_wheelhouse(bench_path='.', apps=list(apps)):
+		sys.exit(1)
+
+
+@click.command('prune', help="Remove older versions of packages from the wheelhouse")
+@click.option('--keep', type=int, default=1, help="Number of versions of each package to keep")
+def prune_wheelhouse(keep):
+	from bench.utils import prune_wheelhouse
+	prune_wheelhouse(bench_path='.', keep=keep)
+
+
+wheelhouse.add_command(build_wheelhouse)
+wheelhouse.add_command(prune_wheelhouse)
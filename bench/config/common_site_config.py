@@ -4,9 +4,6 @@ import json
 import multiprocessing
 import os
 
-# imports - third party imports
-from six.moves.urllib.parse import urlparse
-
 
 default_config = {
 	'restart_supervisor_on_update': False,
@@ -73,43 +70,10 @@ def update_config_for_frappe(config, bench_path):
 	# TODO Optionally we need to add the host or domain name in case dns_multitenant is false
 
 def make_ports(bench_path):
-	benches_path = os.path.dirname(os.path.abspath(bench_path))
-
-	default_ports = {
-		"webserver_port": 8000,
-		"socketio_port": 9000,
-		"file_watcher_port": 6787,
-		"redis_queue": 11000,
-		"redis_socketio": 12000,
-		"redis_cache": 13000
-	}
-
-	# collect all existing ports
-	existing_ports = {}
-	for folder in os.listdir(benches_path):
-		bench_path = os.path.join(benches_path, folder)
-		if os.path.isdir(bench_path):
-			bench_config = get_config(bench_path)
-			for key in list(default_ports.keys()):
-				value = bench_config.get(key)
-
-				# extract port from redis url
-				if value and (key in ('redis_cache', 'redis_queue', 'redis_socketio')):
-					value = urlparse(value).port
-
-				if value:
-					existing_ports.setdefault(key, []).append(value)
-
-	# new port value = max of existing port value + 1
-	ports = {}
-	for key, value in list(default_ports.items()):
-		existing_value = existing_ports.get(key, [])
-		if existing_value:
-			value = max(existing_value) + 1
-
-		ports[key] = value
+	"""Returns the bench's ports from the host's port registry, allocating them if it has none"""
+	from bench.config.ports import allocate_ports
 
-	return ports
+	return allocate_ports(bench_path)
 
 def make_pid_folder(bench_path):
 	pids_path = os.path.join(bench_path, 'config', 'pids')
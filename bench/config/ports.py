@@ -0,0 +1,301 @@
+"""Host-wide registry of the ports allocated to benches
+
+Every bench on a host needs its own webserver, socketio, file watcher and redis ports. They are
+recorded in /var/lib/bench/ports.json (or BENCH_PORTS_REGISTRY), which the benches of every user
+on the host share and which is only read and changed while holding a lock on it, so that benches
+created at the same time never get the same ports. The first time a directory of benches is
+seen, the ports of the benches already in it are added to the registry. A bench keeps its ports
+until they are freed, or until it has been missing for longer than a grace period, so that the
+benches on a volume that isn't mounted don't lose theirs.
+"""
+
+# imports - standard imports
+import json
+import os
+import time
+
+# imports - third party imports
+from six.moves.urllib.parse import urlparse
+
+# imports - module imports
+from bench.utils import file_lock, log, makedirs_safe, print_summary_table
+
+
+default_ports = {
+	"webserver_port": 8000,
+	"socketio_port": 9000,
+	"file_watcher_port": 6787,
+	"redis_queue": 11000,
+	"redis_socketio": 12000,
+	"redis_cache": 13000
+}
+
+redis_keys = ('redis_cache', 'redis_queue', 'redis_socketio')
+
+shared_registry_path = os.path.join(os.sep, 'var', 'lib', 'bench', 'ports.json')
+
+# how long a bench can be missing before its ports are released
+missing_bench_grace_period = 7 * 24 * 60 * 60
+
+
+def get_registry_path():
+	"""Returns BENCH_PORTS_REGISTRY, or else the registry shared by the benches on the host.
+	Users who can't create or change the shared registry get one of their own in ~/.bench"""
+	path = os.environ.get('BENCH_PORTS_REGISTRY')
+	if path:
+		return os.path.abspath(os.path.expanduser(path))
+
+	if all(is_writable(path) for path in (shared_registry_path, shared_registry_path + '.lock')):
+		return shared_registry_path
+
+	return get_user_registry_path()
+
+
+def get_user_registry_path():
+	return os.path.abspath(os.path.expanduser(os.path.join('~', '.bench', 'ports.json')))
+
+
+def is_writable(path):
+	"""Whether path can be changed, or created in the closest of its parents that exists"""
+	while not os.path.exists(path):
+		path = os.path.dirname(path)
+	return os.access(path, os.W_OK)
+
+
+def is_shared(registry_path):
+	return registry_path != get_user_registry_path()
+
+
+def share(path, mode):
+	"""Lets the other users on the host change path, if it's ours"""
+	try:
+		os.chmod(path, mode)
+	except OSError:
+		pass
+
+
+def read_registry():
+	try:
+		with open(get_registry_path(), 'r') as f:
+			registry = json.load(f)
+	except (IOError, ValueError):
+		registry = {}
+
+	registry.setdefault('benches', {})
+	registry.setdefault('scanned', [])
+	registry.setdefault('missing', {})
+	return registry
+
+
+def write_registry(registry):
+	registry_path = get_registry_path()
+	tmp_file = '{0}.{1}.tmp'.format(registry_path, os.getpid())
+	with open(tmp_file, 'w') as f:
+		json.dump(registry, f, indent=1, sort_keys=True)
+	if is_shared(registry_path):
+		share(tmp_file, 0o666)
+	os.rename(tmp_file, registry_path)
+
+
+def registry_lock():
+	registry_path = get_registry_path()
+	registry_dir, lock_file = os.path.dirname(registry_path), registry_path + '.lock'
+
+	if not os.path.isdir(registry_dir):
+		makedirs_safe(registry_dir)
+		if is_shared(registry_path):
+			share(registry_dir, 0o777)
+
+	if not os.path.exists(lock_file):
+		open(lock_file, 'a').close()
+		if is_shared(registry_path):
+			share(lock_file, 0o666)
+
+	return file_lock(lock_file)
+
+
+def allocate_ports(bench_path):
+	"""Returns the ports of the bench, allocating the lowest free ones for those it doesn't have
+	yet. A bench keeps the ports it has in its common_site_config"""
+	bench_path = os.path.abspath(bench_path)
+
+	if not is_shared(get_registry_path()):
+		log("Allocating ports from {0}, as {1} can't be changed. The benches of other users may get the same ports, unless BENCH_PORTS_REGISTRY points them all to one registry".format(
+			get_registry_path(), shared_registry_path), level=3)
+
+	with registry_lock():
+		registry = read_registry()
+		prune_registry(registry)
+		seed_registry(registry, os.path.dirname(bench_path))
+
+		ports = registry['benches'].get(bench_path) or get_bench_ports(bench_path)
+		used_ports = get_used_ports(registry, exclude=bench_path)
+		for key, port in sorted(default_ports.items()):
+			if not ports.get(key):
+				while port in used_ports[key]:
+					port += 1
+				ports[key] = port
+
+		registry['benches'][bench_path] = ports
+		write_registry(registry)
+
+	return ports
+
+
+def free_ports(bench_path):
+	"""Releases the ports of the bench, for the next bench that is created. Returns whether it
+	had any"""
+	bench_path = os.path.abspath(bench_path)
+
+	with registry_lock():
+		registry = read_registry()
+		registry['missing'].pop(bench_path, None)
+		if registry['benches'].pop(bench_path, None):
+			write_registry(registry)
+			return True
+
+	return False
+
+
+def get_bench_ports(bench_path):
+	"""Returns the ports set in the bench's common_site_config"""
+	from bench.config.common_site_config import get_config
+
+	try:
+		config = get_config(bench_path)
+	except (IOError, ValueError):
+		return {}
+
+	ports = {}
+	for key in default_ports:
+		value = config.get(key)
+
+		# extract port from redis url
+		if value and key in redis_keys:
+			value = urlparse(value).port
+
+		if value:
+			ports[key] = value
+
+	return ports
+
+
+def get_used_ports(registry, exclude=None):
+	used_ports = dict((key, set()) for key in default_ports)
+	for bench_path, ports in registry['benches'].items():
+		if bench_path != exclude:
+			for key, port in ports.items():
+				used_ports.setdefault(key, set()).add(port)
+
+	return used_ports
+
+
+def is_bench(path):
+	return os.path.exists(os.path.join(path, 'sites', 'common_site_config.json'))
+
+
+def prune_registry(registry, now=None):
+	"""Drops the benches that have been missing for longer than the grace period. Returns their
+	paths"""
+	now = now or time.time()
+	missing = registry['missing']
+
+	stale_benches = []
+	for bench_path in sorted(registry['benches']):
+		# a bench that is being created has its ports before its common_site_config
+		if os.path.isdir(bench_path):
+			missing.pop(bench_path, None)
+		elif now - missing.setdefault(bench_path, now) > missing_bench_grace_period:
+			stale_benches.append(bench_path)
+
+	for bench_path in stale_benches:
+		del registry['benches'][bench_path]
+	for bench_path in list(missing):
+		if bench_path not in registry['benches']:
+			del missing[bench_path]
+
+	return stale_benches
+
+
+def seed_registry(registry, benches_path, force=False):
+	"""Registers the ports of the benches in benches_path, the first time it is seen"""
+	if benches_path in registry['scanned'] and not force:
+		return
+
+	for folder in sorted(os.listdir(benches_path)):
+		bench_path = os.path.join(benches_path, folder)
+		if bench_path not in registry['benches'] and is_bench(bench_path):
+			ports = get_bench_ports(bench_path)
+			if ports:
+				registry['benches'][bench_path] = ports
+
+	if benches_path not in registry['scanned']:
+		registry['scanned'].append(benches_path)
+
+
+def get_conflicts(registry):
+	"""Returns (key, port, bench paths) for the ports allocated to more than one bench"""
+	benches_by_port = {}
+	for bench_path, ports in registry['benches'].items():
+		for key, port in ports.items():
+			benches_by_port.setdefault((key, port), []).append(bench_path)
+
+	return [(key, port, sorted(bench_paths)) for (key, port), bench_paths in sorted(benches_by_port.items())
+		if len(bench_paths) > 1]
+
+
+def repair_ports(bench_path='.'):
+	"""Brings the registry in line with the benches: drops removed benches, registers those in
+	the bench's directory and rereads the ports of every bench from its common_site_config.
+	Ports the bench shares with another bench are reallocated. Returns the bench's new ports"""
+	from bench.config.common_site_config import update_config
+
+	bench_path = os.path.abspath(bench_path)
+
+	with registry_lock():
+		registry = read_registry()
+		for stale_bench in prune_registry(registry):
+			log("Released the ports of {0}, which has been missing for over a week".format(stale_bench))
+
+		seed_registry(registry, os.path.dirname(bench_path), force=True)
+		for path in registry['benches']:
+			registry['benches'][path] = get_bench_ports(path) or registry['benches'][path]
+
+		ports = registry['benches'].get(bench_path, {})
+		used_ports = get_used_ports(registry, exclude=bench_path)
+		changed_ports = {}
+		for key, port in sorted(default_ports.items()):
+			if not ports.get(key) or ports[key] in used_ports[key]:
+				while port in used_ports[key]:
+					port += 1
+				changed_ports[key] = ports[key] = port
+
+		if os.path.isdir(bench_path):
+			registry['benches'][bench_path] = ports
+		write_registry(registry)
+
+	if changed_ports and os.path.isdir(bench_path):
+		update_config(dict((key, "redis://localhost:{0}".format(port) if key in redis_keys else port)
+			for key, port in changed_ports.items()), bench_path=bench_path)
+		log("Allocated {0}. Run `bench setup redis` and `bench setup procfile` to use the new ports".format(
+			", ".join("{0} to {1}".format(key, port) for key, port in sorted(changed_ports.items()))), level=3)
+
+	for key, port, bench_paths in get_conflicts(registry):
+		log("{0} {1} is used by {2}".format(key, port, ", ".join(bench_paths)), level=3)
+
+	return ports
+
+
+def print_ports():
+	registry = read_registry()
+	keys = sorted(default_ports)
+	rows = [[bench_path] + [str(ports.get(key, '')) for key in keys] + ['' if os.path.isdir(bench_path) else 'missing']
+		for bench_path, ports in sorted(registry['benches'].items())]
+
+	if rows:
+		print_summary_table(['Bench'] + keys + [''], rows)
+	else:
+		print("No ports are allocated in {0}".format(get_registry_path()))
+
+	for key, port, bench_paths in get_conflicts(registry):
+		log("{0} {1} is used by {2}".format(key, port, ", ".join(bench_paths)), level=3)
@@ -0,0 +1,223 @@
+"""Blue/green deployments of a bench's code
+
+A staged `bench update` doesn't touch the live apps, env and assets. It prepares a release in
+deployments/<id>, a bench of its own that hardlinks the current apps, gets a fresh env, shares
+the sites through symlinks and builds its assets into its own sites/assets. Once it's ready, the
+bench's apps, env and sites/assets, which are symlinks into deployments/current, are switched
+over by atomically replacing the deployments/current symlink.
+"""
+
+# imports - standard imports
+import glob
+import os
+import shutil
+from datetime import datetime
+
+# imports - module imports
+from bench.utils import exec_cmd, get_bench_state, get_env_cmd, get_venv_path, log, print_summary_table, run_parallel, set_bench_state
+
+
+# the state bench keeps about the code in apps and env, which belongs to a release
+release_state = ('python_requirements', 'node_packages', 'build_fingerprints', 'migration_fingerprints', 'migrated_code',
+	'prefetch')
+
+# paths the release links to, relative to the bench and to deployments/current
+release_links = (('apps',), ('env',), ('sites', 'assets'))
+
+
+def get_deployments_path(bench_path='.'):
+	return os.path.join(os.path.abspath(bench_path), 'deployments')
+
+
+def get_release_path(release, bench_path='.'):
+	return os.path.join(get_deployments_path(bench_path=bench_path), release)
+
+
+def get_current_release(bench_path='.'):
+	current = os.path.join(get_deployments_path(bench_path=bench_path), 'current')
+	return os.readlink(current) if os.path.islink(current) else None
+
+
+def get_new_release_id(bench_path='.'):
+	release = datetime.now().strftime('%Y%m%d-%H%M%S')
+	suffix = 1
+	while os.path.exists(get_release_path(release, bench_path=bench_path)):
+		suffix += 1
+		release = '{0}-{1}'.format(datetime.now().strftime('%Y%m%d-%H%M%S'), suffix)
+
+	return release
+
+
+def stage_release(bench_path='.', jobs=1):
+	"""Creates a release from the bench's current apps, which can be updated and built without
+	affecting the running bench. Returns its path"""
+	bench_path = os.path.abspath(bench_path)
+	release_path = get_release_path(get_new_release_id(bench_path=bench_path), bench_path=bench_path)
+	print('Staging release {0}...'.format(os.path.basename(release_path)))
+
+	os.makedirs(os.path.join(release_path, 'apps'))
+	os.makedirs(os.path.join(release_path, 'config', 'pids'))
+	os.makedirs(os.path.join(release_path, 'sites', 'assets'))
+	os.symlink(os.path.join(bench_path, 'logs'), os.path.join(release_path, 'logs'))
+
+	# the release shares the sites, apps.txt and common_site_config.json, but not the assets
+	sites_path = os.path.join(bench_path, 'sites')
+	for name in os.listdir(sites_path):
+		if name != 'assets':
+			os.symlink(os.path.join(sites_path, name), os.path.join(release_path, 'sites', name))
+
+	apps_path = os.path.join(bench_path, 'apps')
+	run_parallel(lambda app: clone_app(os.path.join(apps_path, app), os.path.join(release_path, 'apps', app)),
+		sorted(os.listdir(apps_path)), jobs=jobs)
+
+	# the release gets a fresh env, so every app is installed in it
+	for name in release_state:
+		if name != 'python_requirements':
+			set_bench_state(name, get_bench_state(name, bench_path=bench_path), bench_path=release_path)
+
+	return release_path
+
+
+def clone_app(app_path, release_app_path):
+	"""Copies an app by hardlinking its files. git and the build tools replace the files they
+	change, except for those copied here, which are updated in place and would change the live
+	app through the hardlinks"""
+	exec_cmd('cp -al {0} {1}'.format(app_path, release_app_path))
+
+	unshared_paths = [os.path.join('.git', name) for name in os.listdir(os.path.join(app_path, '.git'))
+		if name != 'objects'] if os.path.isdir(os.path.join(app_path, '.git')) else []
+	unshared_paths.append('node_modules')
+	unshared_paths.extend(os.path.relpath(path, app_path) for path in glob.glob(os.path.join(app_path, '*.egg-info')))
+	unshared_paths.extend(os.path.relpath(path, app_path) for path in glob.glob(os.path.join(app_path, '*', 'public', 'dist')))
+
+	for path in unshared_paths:
+		source, target = os.path.join(app_path, path), os.path.join(release_app_path, path)
+		if os.path.isdir(target) and not os.path.islink(target):
+			shutil.rmtree(target)
+		elif os.path.lexists(target):
+			os.remove(target)
+		else:
+			continue
+
+		if os.path.isdir(source) and not os.path.islink(source):
+			shutil.copytree(source, target, symlinks=True)
+		else:
+			shutil.copy2(source, target)
+
+
+def setup_release_env(release_path, bench_path='.'):
+	"""Creates the release's env with the Python of the bench's env"""
+	python = os.path.realpath(get_env_cmd('python', bench_path=bench_path))
+	exec_cmd('{0} -q env -p {1}'.format(get_venv_path(), python), cwd=release_path)
+
+
+def activate_release(release, bench_path='.'):
+	"""Switches the bench over to the release by replacing the deployments/current symlink"""
+	bench_path = os.path.abspath(bench_path)
+	deployments_path = get_deployments_path(bench_path=bench_path)
+	current = get_current_release(bench_path=bench_path)
+
+	if current:
+		# hand the state of the current release back to it, for a rollback
+		copy_release_state(bench_path, get_release_path(current, bench_path=bench_path))
+	else:
+		adopt_bench(bench_path=bench_path)
+
+	copy_release_state(get_release_path(release, bench_path=bench_path), bench_path)
+
+	current_link = os.path.join(deployments_path, 'current')
+	tmp_link = '{0}.{1}.tmp'.format(current_link, os.getpid())
+	os.symlink(release, tmp_link)
+	os.rename(tmp_link, current_link)
+
+	history = [r for r in get_bench_state('deployments', bench_path=bench_path).get('history', []) if r != release]
+	set_bench_state('deployments', {'history': history + [release]}, bench_path=bench_path)
+	log("Switched to release {0}".format(release), level=1)
+
+
+def adopt_bench(bench_path='.'):
+	"""Moves the bench's apps, env and assets into a release of their own, and replaces them
+	with symlinks into deployments/current"""
+	release = get_new_release_id(bench_path=bench_path)
+	release_path = get_release_path(release, bench_path=bench_path)
+	os.makedirs(os.path.join(release_path, 'sites'))
+	os.makedirs(os.path.join(release_path, 'config', 'pids'))
+	os.symlink(os.path.join(bench_path, 'logs'), os.path.join(release_path, 'logs'))
+	copy_release_state(bench_path, release_path)
+
+	os.symlink(release, os.path.join(get_deployments_path(bench_path=bench_path), 'current'))
+	for parts in release_links:
+		path = os.path.join(bench_path, *parts)
+		link = os.path.relpath(os.path.join(bench_path, 'deployments', 'current', *parts), os.path.dirname(path))
+
+		if os.path.lexists(path):
+			os.rename(path, os.path.join(release_path, *parts))
+		else:
+			os.makedirs(os.path.join(release_path, *parts))
+		os.symlink(link, path)
+
+	set_bench_state('deployments', {'history': [release]}, bench_path=bench_path)
+
+
+def copy_release_state(source_path, target_path):
+	for name in release_state:
+		set_bench_state(name, get_bench_state(name, bench_path=source_path), bench_path=target_path)
+
+
+def remove_release(release, bench_path='.'):
+	if release == get_current_release(bench_path=bench_path):
+		raise ValueError("Release {0} is the current release".format(release))
+
+	shutil.rmtree(get_release_path(release, bench_path=bench_path))
+
+
+def get_releases(bench_path='.'):
+	"""Returns the releases that have been active, most recent first"""
+	history = get_bench_state('deployments', bench_path=bench_path).get('history', [])
+	return [release for release in reversed(history) if os.path.isdir(get_release_path(release, bench_path=bench_path))]
+
+
+def prune_releases(bench_path='.', keep=3):
+	"""Removes all but the `keep` most recently active releases"""
+	for release in get_releases(bench_path=bench_path)[max(keep, 1):]:
+		if release != get_current_release(bench_path=bench_path):
+			remove_release(release, bench_path=bench_path)
+
+	history = get_bench_state('deployments', bench_path=bench_path).get('history', [])
+	set_bench_state('deployments', {'history': [release for release in history
+		if os.path.isdir(get_release_path(release, bench_path=bench_path))]}, bench_path=bench_path)
+
+
+def rollback(release=None, bench_path='.'):
+	"""Switches back to the given release, or to the one that was active before the current one"""
+	current = get_current_release(bench_path=bench_path)
+	releases = [r for r in get_releases(bench_path=bench_path) if r != current]
+
+	if not release:
+		if not releases:
+			log("There is no earlier release to roll back to", level=2)
+			return False
+		release = releases[0]
+	elif release not in releases:
+		log("Release {0} doesn't exist or is the current release".format(release), level=2)
+		return False
+
+	activate_release(release, bench_path=bench_path)
+	return True
+
+
+def print_releases(bench_path='.'):
+	from bench.app import get_head_commit
+
+	current = get_current_release(bench_path=bench_path)
+	rows = []
+	for release in get_releases(bench_path=bench_path):
+		apps_path = os.path.join(get_release_path(release, bench_path=bench_path), 'apps')
+		commits = ["{0}@{1}".format(app, (get_head_commit(app, bench_path=os.path.dirname(apps_path)) or '')[:7])
+			for app in sorted(os.listdir(apps_path))] if os.path.isdir(apps_path) else []
+		rows.append(('*' if release == current else '', release, " ".join(commits)))
+
+	if rows:
+		print_summary_table(('', 'Release', 'Apps'), rows)
+	else:
+		print("No releases, run `bench update --staged` to create one")
@@ -0,0 +1,235 @@
+"""Preforking server for frappe's bench_helper
+
+`bench helper-server start` runs this file with the bench's env python from the sites
+directory. The server imports frappe and every app's commands once and then forks for each
+request, so that a frappe command no longer pays for interpreter startup and imports.
+
+Clients hand over their stdin, stdout and stderr file descriptors along with the request, so
+the forked worker writes to the same terminal, file or pipe that a spawned
+`python -m frappe.utils.bench_helper` would have, and the exit code (or terminating signal)
+of the worker is sent back to the client.
+
+This module must not import bench or anything outside the standard library, as the env
+python doesn't have bench installed.
+"""
+
+# imports - standard imports
+import array
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import traceback
+
+
+MAX_FDS = 3
+header = struct.Struct('!I')
+
+
+def serve(socket_path):
+	# running this file as a script puts the bench package on sys.path, where it would shadow
+	# modules like `utils` and `config`. Mimic `python -m`, which puts the cwd first instead
+	sys.path[0] = os.getcwd()
+
+	import frappe.utils.bench_helper as bench_helper
+	try:
+		bench_helper.get_app_groups()
+	except Exception:
+		traceback.print_exc()
+
+	if os.path.exists(socket_path):
+		os.unlink(socket_path)
+
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(socket_path)
+	os.chmod(socket_path, 0o600)
+	server.listen(64)
+
+	def shutdown(signum, frame):
+		server.close()
+		if os.path.exists(socket_path):
+			os.unlink(socket_path)
+		os._exit(0)
+
+	signal.signal(signal.SIGTERM, shutdown)
+	signal.signal(signal.SIGINT, shutdown)
+	# request handlers are never waited on, let the kernel reap them
+	signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+	print("Helper server listening on {0}".format(socket_path))
+	sys.stdout.flush()
+	sys.stderr.flush()
+
+	while True:
+		conn, _ = server.accept()
+		if os.fork() == 0:
+			server.close()
+			try:
+				handle_request(conn, bench_helper)
+			except Exception:
+				traceback.print_exc()
+			finally:
+				os._exit(0)
+		conn.close()
+
+
+def handle_request(conn, bench_helper):
+	"""Runs in a fork of the server: receives one request, forks the worker that executes it
+	and reports the worker's exit status back to the client"""
+	for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+		signal.signal(signum, signal.SIG_DFL)
+
+	request, fds = receive_request(conn)
+
+	pid = os.fork()
+	if pid == 0:
+		conn.close()
+		run_worker(request, fds, bench_helper)
+
+	for fd in fds:
+		os.close(fd)
+
+	send_message(conn, {'pid': pid})
+	_, status = os.waitpid(pid, 0)
+
+	if os.WIFSIGNALED(status):
+		send_message(conn, {'signal': os.WTERMSIG(status)})
+	else:
+		send_message(conn, {'exit': os.WEXITSTATUS(status)})
+	conn.close()
+
+
+def run_worker(request, fds, bench_helper):
+	signal.signal(signal.SIGINT, signal.default_int_handler)
+
+	for target, fd in enumerate(fds):
+		os.dup2(fd, target)
+		os.close(fd)
+
+	sys.stdin = os.fdopen(0, 'r')
+	sys.stdout = os.fdopen(1, 'w', 1 if os.isatty(1) else -1)
+	sys.stderr = os.fdopen(2, 'w', 1)
+
+	os.chdir(request['cwd'])
+	os.environ.clear()
+	os.environ.update(request['env'])
+	sys.argv = [bench_helper.__file__] + request['args']
+
+	exit_code = 0
+	try:
+		bench_helper.main()
+	except SystemExit as e:
+		if e.code is None:
+			exit_code = 0
+		elif isinstance(e.code, int):
+			exit_code = e.code
+		else:
+			sys.stderr.write('{0}\n'.format(e.code))
+			exit_code = 1
+	except BaseException:
+		traceback.print_exc()
+		exit_code = 1
+	finally:
+		sys.stdout.flush()
+		sys.stderr.flush()
+
+	os._exit(exit_code)
+
+
+def receive_request(conn):
+	fds = array.array('i')
+	data, ancdata, _, _ = conn.recvmsg(65536, socket.CMSG_LEN(MAX_FDS * fds.itemsize))
+	for level, kind, cmsg_data in ancdata:
+		if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+			fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+
+	while len(data) < header.size or len(data) < header.size + header.unpack(data[:header.size])[0]:
+		chunk = conn.recv(65536)
+		if not chunk:
+			raise EOFError("Incomplete request")
+		data += chunk
+
+	length = header.unpack(data[:header.size])[0]
+	request = json.loads(data[header.size:header.size + length].decode('utf-8'))
+	return request, list(fds)
+
+
+def send_message(conn, message):
+	conn.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+def call(socket_path, args, cwd, fds=(0, 1, 2), close_fds=(), env=None):
+	"""Runs `python -m frappe.utils.bench_helper *args` on the helper server listening on
+	socket_path and returns its exit code, negative if the command was killed by a signal.
+
+	fds are the stdin, stdout and stderr the command should use, close_fds are closed as soon
+	as they have been handed over. Raises socket.error if the request couldn't be sent, in which
+	case the command didn't run. Once it is sent, the command may be running, so losing the
+	server after that returns 1 instead"""
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socket_path)
+
+		payload = json.dumps({
+			'args': list(args),
+			'cwd': os.path.abspath(cwd),
+			'env': dict(env if env is not None else os.environ)
+		}).encode('utf-8')
+		data = header.pack(len(payload)) + payload
+
+		# the server ignores a request it didn't receive in full
+		sent = sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+		sock.sendall(data[sent:])
+	except socket.error:
+		sock.close()
+		raise
+
+	worker_pid = None
+	previous_handlers = {}
+	try:
+		for fd in close_fds:
+			os.close(fd)
+
+		for line in sock.makefile('r'):
+			message = json.loads(line)
+
+			if 'pid' in message:
+				worker_pid = message['pid']
+				previous_handlers = forward_signals(worker_pid)
+			elif 'signal' in message:
+				return -message['signal']
+			elif 'exit' in message:
+				return message['exit']
+	except (socket.error, ValueError) as e:
+		sys.stderr.write("Lost the connection to the helper server: {0}\n".format(e))
+	finally:
+		for signum, handler in previous_handlers.items():
+			signal.signal(signum, handler)
+		sock.close()
+
+	# the server went away before reporting the exit status
+	return 1
+
+
+def forward_signals(pid):
+	"""Relays signals meant for the client to the worker, as the worker isn't in the
+	terminal's process group. Only possible from the main thread"""
+	def relay(signum, frame):
+		try:
+			os.kill(pid, signum)
+		except OSError:
+			pass
+
+	previous_handlers = {}
+	for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT):
+		try:
+			previous_handlers[signum] = signal.signal(signum, relay)
+		except ValueError:
+			break
+	return previous_handlers
+
+
+if __name__ == '__main__':
+	serve(sys.argv[1])
@@ -0,0 +1,106 @@
+# imports - standard imports
+import sys
+import threading
+import time
+
+# imports - third party imports
+import six
+
+# imports - module imports
+from bench import trace
+
+
+class Stage(object):
+	"""A step of a bench operation, which may only start once the stages it requires are done"""
+	def __init__(self, name, func, requires=()):
+		self.name = name
+		self.func = func
+		self.requires = list(requires)
+		self.start = None
+		self.end = None
+
+
+def run_stages(stages):
+	"""Runs every stage as soon as the stages it requires have finished, concurrently with the
+	other stages that are ready. Requirements on stages that aren't part of the run are ignored,
+	so stages that weren't asked for can simply be left out.
+
+	Once a stage fails no more stages are started, and the failure is raised again after the
+	running stages have finished. Returns the stages in the order they finished"""
+	names = set(stage.name for stage in stages)
+	pending = list(stages)
+	running = set()
+	finished = []
+	errors = []
+	condition = threading.Condition()
+
+	def run(stage):
+		try:
+			with trace.span(stage.name, category='stage'):
+				stage.func()
+		except BaseException:
+			with condition:
+				errors.append(sys.exc_info())
+		finally:
+			with condition:
+				stage.end = time.time()
+				running.remove(stage.name)
+				finished.append(stage)
+				condition.notify()
+
+	with condition:
+		while running or (pending and not errors):
+			done = set(stage.name for stage in finished)
+			ready = [stage for stage in pending if not errors
+				and all(name in done or name not in names for name in stage.requires)]
+
+			if not ready and not running:
+				raise ValueError("Stages {0} require each other".format(", ".join(stage.name for stage in pending)))
+
+			for stage in ready:
+				pending.remove(stage)
+				running.add(stage.name)
+				stage.start = time.time()
+
+				thread = threading.Thread(target=run, args=(stage,), name=stage.name)
+				thread.daemon = True
+				thread.start()
+
+			# wait with a timeout, Python 2 doesn't deliver KeyboardInterrupt during a bare wait
+			condition.wait(1)
+
+	if errors:
+		six.reraise(*errors[0])
+
+	return finished
+
+
+def get_critical_path(stages):
+	"""Returns the chain of stages that decided how long the run took: the stage that finished
+	last, preceded by the last to finish of the stages it required, and so on"""
+	stages_by_name = dict((stage.name, stage) for stage in stages)
+	critical_path = []
+
+	stage = max(stages, key=lambda stage: stage.end) if stages else None
+	while stage:
+		critical_path.insert(0, stage)
+		required = [stages_by_name[name] for name in stage.requires if name in stages_by_name]
+		stage = max(required, key=lambda stage: stage.end) if required else None
+
+	return critical_path
+
+
+def print_stage_summary(stages):
+	from bench.utils import print_summary_table
+
+	if not stages:
+		return
+
+	started = min(stage.start for stage in stages)
+	rows = [(stage.name, "{0:.1f}s".format(stage.start - started), "{0:.1f}s".format(stage.end - stage.start))
+		for stage in sorted(stages, key=lambda stage: stage.start)]
+	print_summary_table(("Stage", "Started", "Took"), rows)
+
+	critical_path = get_critical_path(stages)
+	print("Critical path: {0} ({1:.1f}s of {2:.1f}s)".format(" > ".join(stage.name for stage in critical_path),
+		sum(stage.end - stage.start for stage in critical_path), max(stage.end for stage in stages) - started))
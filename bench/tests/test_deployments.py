@@ -0,0 +1,100 @@
+# imports - standard imports
+import os
+import shutil
+import tempfile
+import unittest
+
+# imports - module imports
+from bench.deployments import activate_release, adopt_bench, get_current_release, get_release_path, get_releases, prune_releases, rollback, stage_release
+from bench.utils import get_bench_state, set_bench_state
+
+
+class TestDeployments(unittest.TestCase):
+	def setUp(self):
+		self.bench_path = tempfile.mkdtemp()
+		for path in ("apps/frappe/frappe", "env/bin", "sites/assets/js", "sites/a.local", "config", "logs"):
+			os.makedirs(os.path.join(self.bench_path, path))
+
+		self.write("apps/frappe/frappe/__init__.py", "__version__ = '12.0.0'")
+		self.write("env/bin/python", "")
+		self.write("sites/assets/js/frappe.min.js", "frappe")
+		self.write("sites/a.local/site_config.json", "{}")
+		self.write("sites/apps.txt", "frappe")
+		set_bench_state("node_packages", {"frappe": "live"}, bench_path=self.bench_path)
+
+	def tearDown(self):
+		shutil.rmtree(self.bench_path, ignore_errors=True)
+
+	def write(self, path, content):
+		with open(os.path.join(self.bench_path, path), "w") as f:
+			f.write(content)
+
+	def read(self, path):
+		with open(os.path.join(self.bench_path, path)) as f:
+			return f.read()
+
+	def stage(self, version):
+		release_path = stage_release(bench_path=self.bench_path)
+		# the file is hardlinked to the live app's, replace it like git would
+		init_file = os.path.join(release_path, "apps", "frappe", "frappe", "__init__.py")
+		os.remove(init_file)
+		with open(init_file, "w") as f:
+			f.write("__version__ = '{0}'".format(version))
+		os.makedirs(os.path.join(release_path, "env"))
+		set_bench_state("node_packages", {"frappe": version}, bench_path=release_path)
+		return os.path.basename(release_path)
+
+	def test_adopting_the_bench(self):
+		os.makedirs(os.path.join(self.bench_path, "deployments"))
+		adopt_bench(bench_path=self.bench_path)
+
+		release = get_current_release(bench_path=self.bench_path)
+		self.assertEqual(get_releases(bench_path=self.bench_path), [release])
+		for path in ("apps", "env", os.path.join("sites", "assets")):
+			self.assertTrue(os.path.islink(os.path.join(self.bench_path, path)))
+			self.assertEqual(os.path.realpath(os.path.join(self.bench_path, path)),
+				os.path.realpath(os.path.join(get_release_path(release, bench_path=self.bench_path), path)))
+
+		# the bench works as before through the symlinks, and keeps its sites and state
+		self.assertEqual(self.read("apps/frappe/frappe/__init__.py"), "__version__ = '12.0.0'")
+		self.assertEqual(self.read("sites/assets/js/frappe.min.js"), "frappe")
+		self.assertFalse(os.path.islink(os.path.join(self.bench_path, "sites", "a.local")))
+		self.assertEqual(get_bench_state("node_packages", bench_path=get_release_path(release, bench_path=self.bench_path)), {"frappe": "live"})
+
+	def test_activating_and_rolling_back(self):
+		release = self.stage("13.0.0")
+		# staging leaves the running bench alone
+		self.assertEqual(self.read("apps/frappe/frappe/__init__.py"), "__version__ = '12.0.0'")
+
+		activate_release(release, bench_path=self.bench_path)
+		self.assertEqual(get_current_release(bench_path=self.bench_path), release)
+		self.assertEqual(self.read("apps/frappe/frappe/__init__.py"), "__version__ = '13.0.0'")
+		self.assertEqual(get_bench_state("node_packages", bench_path=self.bench_path), {"frappe": "13.0.0"})
+		# the release has its own assets
+		self.assertFalse(os.path.exists(os.path.join(self.bench_path, "sites", "assets", "js")))
+
+		self.assertTrue(rollback(bench_path=self.bench_path))
+		self.assertNotEqual(get_current_release(bench_path=self.bench_path), release)
+		self.assertEqual(self.read("apps/frappe/frappe/__init__.py"), "__version__ = '12.0.0'")
+		self.assertEqual(self.read("sites/assets/js/frappe.min.js"), "frappe")
+		self.assertEqual(get_bench_state("node_packages", bench_path=self.bench_path), {"frappe": "live"})
+
+		# the current release can't be rolled back to
+		self.assertFalse(rollback(get_current_release(bench_path=self.bench_path), bench_path=self.bench_path))
+
+	def test_pruning_keeps_the_active_release(self):
+		first = self.stage("13.0.0")
+		activate_release(first, bench_path=self.bench_path)
+		adopted = get_releases(bench_path=self.bench_path)[1]
+		second = self.stage("14.0.0")
+		activate_release(second, bench_path=self.bench_path)
+		self.assertTrue(rollback(first, bench_path=self.bench_path))
+
+		prune_releases(bench_path=self.bench_path, keep=2)
+		self.assertEqual(get_releases(bench_path=self.bench_path), [first, second])
+		self.assertFalse(os.path.exists(get_release_path(adopted, bench_path=self.bench_path)))
+
+		prune_releases(bench_path=self.bench_path, keep=0)
+		self.assertEqual(get_releases(bench_path=self.bench_path), [first])
+		self.assertEqual(get_current_release(bench_path=self.bench_path), first)
+		self.assertEqual(self.read("apps/frappe/frappe/__init__.py"), "__version__ = '13.0.0'")
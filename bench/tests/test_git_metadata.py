@@ -0,0 +1,51 @@
+# imports - standard imports
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+# imports - module imports
+import bench.app
+import bench.utils
+
+
+class TestGitMetadata(unittest.TestCase):
+	def setUp(self):
+		self.bench_path = tempfile.mkdtemp()
+		self.repo_dir = os.path.join(self.bench_path, "apps", "frappe")
+		os.makedirs(self.repo_dir)
+
+		self.git("init", "-q")
+		self.git("checkout", "-q", "-b", "develop")
+		self.git("-c", "user.name=bench", "-c", "user.email=bench@example.com", "commit", "-q", "--allow-empty", "-m", "init")
+		self.git("remote", "add", "origin", "https://github.com/example/frappe.git")
+		self.git("remote", "add", "upstream", "https://github.com/frappe/frappe.git")
+		bench.app.clear_git_metadata_cache()
+
+	def tearDown(self):
+		shutil.rmtree(self.bench_path, ignore_errors=True)
+		bench.app.clear_git_metadata_cache()
+
+	def git(self, *args):
+		return subprocess.check_output(("git",) + args, cwd=self.repo_dir).decode("utf-8").strip()
+
+	def test_metadata_matches_git(self):
+		self.assertEqual(bench.app.get_current_branch("frappe", bench_path=self.bench_path), "develop")
+		self.assertEqual(bench.app.get_head_commit("frappe", bench_path=self.bench_path), self.git("rev-parse", "HEAD"))
+		self.assertEqual(bench.app.get_remote("frappe", bench_path=self.bench_path), "upstream")
+		self.assertEqual(bench.app.get_upstream_url("frappe", bench_path=self.bench_path), "https://github.com/frappe/frappe.git")
+
+	def test_packed_refs(self):
+		self.git("pack-refs", "--all")
+		self.assertFalse(os.path.exists(os.path.join(self.repo_dir, ".git", "refs", "heads", "develop")))
+		self.assertEqual(bench.app.get_head_commit("frappe", bench_path=self.bench_path), self.git("rev-parse", "HEAD"))
+
+	def test_cache_cleared_by_exec_cmd(self):
+		self.assertEqual(bench.app.get_current_branch("frappe", bench_path=self.bench_path), "develop")
+		bench.utils.exec_cmd("git checkout -q -b feature/metadata", cwd=self.repo_dir)
+		self.assertEqual(bench.app.get_current_branch("frappe", bench_path=self.bench_path), "feature/metadata")
+
+
+if __name__ == '__main__':
+	unittest.main()
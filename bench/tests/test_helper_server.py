@@ -0,0 +1,109 @@
+# imports - standard imports
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+# imports - module imports
+import bench.utils
+from bench import helper_server
+from bench.cli import get_command_index_key
+
+
+class FakeBenchHelper(object):
+	"""Stands in for frappe.utils.bench_helper in the server's worker"""
+	__file__ = "bench_helper.py"
+
+	@staticmethod
+	def main():
+		print(json.dumps({"args": sys.argv[1:], "cwd": os.getcwd(), "stdin": sys.stdin.read(), "env": os.environ.get("BENCH_TEST")}))
+		sys.exit(3)
+
+
+@unittest.skipUnless(hasattr(socket.socket, "sendmsg"), "the helper server needs socket.sendmsg")
+class TestHelperServer(unittest.TestCase):
+	def setUp(self):
+		self.bench_path = tempfile.mkdtemp()
+		for path in ("config", "sites", os.path.join("env", "bin")):
+			os.makedirs(os.path.join(self.bench_path, path))
+
+		# a spawned frappe command prints its arguments
+		python = os.path.join(self.bench_path, "env", "bin", "python")
+		with open(python, "w") as f:
+			f.write("#!/bin/sh\necho spawned \"$@\"\n")
+		os.chmod(python, 0o755)
+
+		self.socket_path = os.path.join(self.bench_path, "config", "helper_server.sock")
+		self.server = None
+
+	def tearDown(self):
+		if self.server:
+			self.server.close()
+		shutil.rmtree(self.bench_path, ignore_errors=True)
+
+	def listen(self):
+		self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.server.bind(self.socket_path)
+		self.server.listen(1)
+
+	def record_server(self, key=None):
+		bench.utils.set_bench_state("helper_server", {"pid": os.getpid(), "python_version": "3.8.10",
+			"key": key or get_command_index_key(bench_path=self.bench_path)}, bench_path=self.bench_path)
+
+	def serve_one_request(self):
+		"""Handles the next request in a fork, as the server does"""
+		pid = os.fork()
+		if pid == 0:
+			try:
+				conn, _ = self.server.accept()
+				helper_server.handle_request(conn, FakeBenchHelper)
+			finally:
+				os._exit(0)
+		return pid
+
+	def test_command_uses_the_clients_fds(self):
+		self.listen()
+		server_pid = self.serve_one_request()
+
+		stdin_read, stdin_write = os.pipe()
+		stdout_read, stdout_write = os.pipe()
+		os.write(stdin_write, b"input")
+		os.close(stdin_write)
+
+		return_code = helper_server.call(self.socket_path, ["frappe", "--version"], cwd=self.bench_path,
+			fds=(stdin_read, stdout_write, stdout_write), close_fds=(stdin_read, stdout_write), env={"BENCH_TEST": "1"})
+		with os.fdopen(stdout_read) as f:
+			output = json.loads(f.read())
+		os.waitpid(server_pid, 0)
+
+		self.assertEqual(return_code, 3)
+		self.assertEqual(output, {"args": ["frappe", "--version"], "cwd": os.path.realpath(self.bench_path), "stdin": "input", "env": "1"})
+
+	def test_missing_server_falls_back_to_a_subprocess(self):
+		self.record_server()
+		self.assertEqual(bench.utils.run_on_helper_server(("frappe", "--version"), bench_path=self.bench_path), None)
+		self.assertEqual(bench.utils.read_frappe_cmd_output(("--version",), self.bench_path),
+			b"spawned -m frappe.utils.bench_helper frappe --version\n")
+
+	def test_stale_socket_falls_back_to_a_subprocess(self):
+		# the server died without removing its socket
+		self.listen()
+		self.server.close()
+		self.server = None
+		self.record_server()
+
+		self.assertEqual(bench.utils.get_helper_server_socket(bench_path=self.bench_path), self.socket_path)
+		self.assertEqual(bench.utils.run_on_helper_server(("frappe", "--version"), bench_path=self.bench_path), None)
+		self.assertEqual(bench.utils.read_frappe_cmd_output(("--version",), self.bench_path),
+			b"spawned -m frappe.utils.bench_helper frappe --version\n")
+
+	def test_server_with_other_apps_isnt_used(self):
+		self.listen()
+		self.record_server(key="apps before the pull")
+
+		self.assertEqual(bench.utils.get_helper_server_socket(bench_path=self.bench_path), None)
+		self.assertEqual(bench.utils.read_frappe_cmd_output(("--version",), self.bench_path),
+			b"spawned -m frappe.utils.bench_helper frappe --version\n")
@@ -0,0 +1,111 @@
+# imports - standard imports
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# imports - module imports
+from bench.config.common_site_config import get_config, put_config
+from bench.config.ports import allocate_ports, free_ports, missing_bench_grace_period, prune_registry, read_registry, repair_ports
+
+
+class TestPorts(unittest.TestCase):
+	def setUp(self):
+		self.benches_path = tempfile.mkdtemp()
+		self.registry_path = os.path.join(tempfile.mkdtemp(), 'ports.json')
+		os.environ['BENCH_PORTS_REGISTRY'] = self.registry_path
+
+	def tearDown(self):
+		del os.environ['BENCH_PORTS_REGISTRY']
+		shutil.rmtree(self.benches_path)
+		shutil.rmtree(os.path.dirname(self.registry_path))
+
+	def make_bench(self, bench_name, config=None):
+		bench_path = os.path.join(self.benches_path, bench_name)
+		os.makedirs(os.path.join(bench_path, 'sites'))
+		put_config(config or {}, bench_path=bench_path)
+		return bench_path
+
+	def test_benches_get_the_next_ports(self):
+		first = allocate_ports(self.make_bench('test-bench-1'))
+		second = allocate_ports(self.make_bench('test-bench-2'))
+
+		self.assertEqual(first, {"webserver_port": 8000, "socketio_port": 9000, "file_watcher_port": 6787,
+			"redis_queue": 11000, "redis_socketio": 12000, "redis_cache": 13000})
+		self.assertEqual(second, {"webserver_port": 8001, "socketio_port": 9001, "file_watcher_port": 6788,
+			"redis_queue": 11001, "redis_socketio": 12001, "redis_cache": 13001})
+		self.assertEqual(allocate_ports(os.path.join(self.benches_path, 'test-bench-1')), first)
+
+	def test_freed_ports_are_reused(self):
+		allocate_ports(self.make_bench('test-bench-1'))
+		second_path = self.make_bench('test-bench-2')
+		allocate_ports(second_path)
+		free_ports(second_path)
+		self.assertEqual(allocate_ports(self.make_bench('test-bench-3'))['webserver_port'], 8001)
+
+		# removed benches are released once they've been missing for the grace period
+		first_path = os.path.join(self.benches_path, 'test-bench-1')
+		shutil.rmtree(first_path)
+		self.assertEqual(allocate_ports(self.make_bench('test-bench-4'))['webserver_port'], 8002)
+		self.assertTrue(free_ports(first_path))
+		self.assertEqual(allocate_ports(self.make_bench('test-bench-5'))['webserver_port'], 8000)
+
+	def test_missing_benches_keep_their_ports(self):
+		first_path = self.make_bench('test-bench-1')
+		allocate_ports(first_path)
+		# e.g. on a volume that isn't mounted
+		os.rename(first_path, first_path + '.unmounted')
+
+		registry = read_registry()
+		self.assertEqual(prune_registry(registry), [])
+		self.assertIn(first_path, registry['missing'])
+		self.assertEqual(prune_registry(registry, now=time.time() + missing_bench_grace_period / 2), [])
+
+		# it's back before the grace period is over
+		os.rename(first_path + '.unmounted', first_path)
+		self.assertEqual(prune_registry(registry, now=time.time() + missing_bench_grace_period * 2), [])
+		self.assertEqual(registry['missing'], {})
+
+		shutil.rmtree(first_path)
+		prune_registry(registry)
+		self.assertEqual(prune_registry(registry, now=time.time() + missing_bench_grace_period * 2), [first_path])
+		self.assertEqual(registry['benches'], {})
+
+	def test_existing_benches_are_registered(self):
+		self.make_bench('old-bench', {"webserver_port": 8000, "redis_cache": "redis://localhost:13000"})
+		ports = allocate_ports(self.make_bench('test-bench'))
+
+		self.assertEqual(ports['webserver_port'], 8001)
+		self.assertEqual(ports['redis_cache'], 13001)
+		self.assertEqual(ports['socketio_port'], 9000)
+		self.assertIn(os.path.join(self.benches_path, 'old-bench'), read_registry()['benches'])
+
+	def test_concurrent_allocations_dont_collide(self):
+		bench_paths = [self.make_bench('test-bench-{0}'.format(i)) for i in range(8)]
+		results = []
+		threads = [threading.Thread(target=lambda bench_path=bench_path: results.append(allocate_ports(bench_path)))
+			for bench_path in bench_paths]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(sorted(ports['webserver_port'] for ports in results), list(range(8000, 8008)))
+		with open(self.registry_path) as f:
+			self.assertEqual(len(json.load(f)['benches']), 8)
+
+	def test_repair_reallocates_shared_ports(self):
+		first_path = self.make_bench('test-bench-1')
+		allocate_ports(first_path)
+		second_path = self.make_bench('test-bench-2', {"webserver_port": 8000, "redis_queue": "redis://localhost:11000"})
+		allocate_ports(second_path)
+
+		ports = repair_ports(second_path)
+
+		self.assertEqual(ports['webserver_port'], 8001)
+		self.assertEqual(get_config(second_path)['webserver_port'], 8001)
+		self.assertEqual(get_config(second_path)['redis_queue'], "redis://localhost:11001")
+		self.assertEqual(read_registry()['benches'][first_path]['webserver_port'], 8000)
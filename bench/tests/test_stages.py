@@ -0,0 +1,62 @@
+# imports - standard imports
+import threading
+import time
+import unittest
+
+# imports - module imports
+from bench.stages import Stage, get_critical_path, run_stages
+
+
+class TestStages(unittest.TestCase):
+	def setUp(self):
+		self.events = []
+		self.lock = threading.Lock()
+
+	def stage(self, name, requires=(), duration=0.05, error=None):
+		def func():
+			with self.lock:
+				self.events.append(("start", name))
+			time.sleep(duration)
+			with self.lock:
+				self.events.append(("end", name))
+			if error:
+				raise error
+		return Stage(name, func, requires=requires)
+
+	def test_requirements_finish_first(self):
+		stages = [self.stage("build", requires=["pull", "node packages"]), self.stage("node packages", requires=["pull"]), self.stage("pull")]
+		finished = run_stages(stages)
+
+		self.assertEqual([stage.name for stage in finished], ["pull", "node packages", "build"])
+		self.assertLess(self.events.index(("end", "pull")), self.events.index(("start", "node packages")))
+		self.assertLess(self.events.index(("end", "node packages")), self.events.index(("start", "build")))
+
+	def test_independent_stages_overlap(self):
+		run_stages([self.stage("pull"), self.stage("python packages", requires=["pull"], duration=0.2),
+			self.stage("node packages", requires=["pull"], duration=0.2)])
+
+		self.assertLess(self.events.index(("start", "node packages")), self.events.index(("end", "python packages")))
+		self.assertLess(self.events.index(("start", "python packages")), self.events.index(("end", "node packages")))
+
+	def test_stages_left_out_are_ignored(self):
+		finished = run_stages([self.stage("migrate", requires=["backup", "pull"])])
+		self.assertEqual([stage.name for stage in finished], ["migrate"])
+
+	def test_failure_stops_dependent_stages(self):
+		stages = [self.stage("pull", error=SystemExit(1)), self.stage("migrate", requires=["pull"]), self.stage("backup", duration=0.2)]
+
+		with self.assertRaises(SystemExit):
+			run_stages(stages)
+
+		self.assertNotIn(("start", "migrate"), self.events)
+		self.assertIn(("end", "backup"), self.events)
+
+	def test_cyclic_requirements(self):
+		with self.assertRaises(ValueError):
+			run_stages([self.stage("pull", requires=["build"]), self.stage("build", requires=["pull"])])
+
+	def test_critical_path(self):
+		finished = run_stages([self.stage("pull"), self.stage("python packages", requires=["pull"], duration=0.2),
+			self.stage("node packages", requires=["pull"]), self.stage("build", requires=["python packages", "node packages"])])
+
+		self.assertEqual([stage.name for stage in get_critical_path(finished)], ["pull", "python packages", "build"])
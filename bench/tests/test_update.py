@@ -0,0 +1,120 @@
+# imports - standard imports
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from collections import OrderedDict
+
+# imports - module imports
+import bench
+import bench.app
+import bench.utils
+
+
+class TestChangedApps(unittest.TestCase):
+	def setUp(self):
+		self.bench_path = tempfile.mkdtemp()
+		os.makedirs(os.path.join(self.bench_path, "sites"))
+		os.makedirs(os.path.join(self.bench_path, "config"))
+		with open(os.path.join(self.bench_path, "sites", "apps.txt"), "w") as f:
+			f.write("frappe\nerpnext")
+
+		apps = {}
+		for app in ("frappe", "erpnext"):
+			self.git(app, "init", "-q")
+			with open(os.path.join(self.bench_path, "apps", app, "requirements.txt"), "w") as f:
+				f.write("six\n")
+			self.git(app, "add", "requirements.txt")
+			self.git(app, "-c", "user.name=bench", "-c", "user.email=bench@example.com", "commit", "-q", "-m", "init")
+			apps[app] = {"commit": self.git(app, "rev-parse", "HEAD"), "branch": "master"}
+
+		bench.app.clear_git_metadata_cache()
+		bench.utils.set_bench_state("rollback_manifest", {"apps": apps}, bench_path=self.bench_path)
+
+		env_python_version = bench.utils.get_env_python_version(bench_path=self.bench_path)
+		self.installed = dict((app, {"hash": bench.utils.get_requirements_hash(app, env_python_version, bench_path=self.bench_path)})
+			for app in ("frappe", "erpnext"))
+
+	def tearDown(self):
+		shutil.rmtree(self.bench_path, ignore_errors=True)
+		bench.app.clear_git_metadata_cache()
+
+	def git(self, app, *args):
+		repo_dir = os.path.join(self.bench_path, "apps", app)
+		if not os.path.isdir(repo_dir):
+			os.makedirs(repo_dir)
+		return subprocess.check_output(("git",) + args, cwd=repo_dir).decode("utf-8").strip()
+
+	def test_unchanged_apps_are_skipped(self):
+		bench.utils.set_bench_state("python_requirements", self.installed, bench_path=self.bench_path)
+		self.assertEqual(bench.utils.get_apps_to_update("python packages", bench_path=self.bench_path), [])
+
+	def test_pulled_apps_are_updated(self):
+		bench.utils.set_bench_state("python_requirements", self.installed, bench_path=self.bench_path)
+		self.git("erpnext", "-c", "user.name=bench", "-c", "user.email=bench@example.com", "commit", "-q", "--allow-empty", "-m", "pull")
+		bench.app.clear_git_metadata_cache()
+
+		self.assertEqual(bench.utils.get_apps_to_update("python packages", bench_path=self.bench_path), ["erpnext"])
+
+	def test_failed_install_is_retried(self):
+		# the last install of erpnext failed, so its requirements weren't recorded
+		del self.installed["erpnext"]
+		bench.utils.set_bench_state("python_requirements", self.installed, bench_path=self.bench_path)
+
+		self.assertEqual(bench.utils.get_apps_to_update("python packages", bench_path=self.bench_path), ["erpnext"])
+		self.assertEqual(bench.utils.get_apps_to_update(None, bench_path=self.bench_path), [])
+
+
+class TestPatchSites(unittest.TestCase):
+	def setUp(self):
+		self.bench_path = tempfile.mkdtemp()
+		os.makedirs(os.path.join(self.bench_path, "config"))
+		for site in ("a.local", "b.local"):
+			os.makedirs(os.path.join(self.bench_path, "sites", site))
+			with open(os.path.join(self.bench_path, "sites", site, "site_config.json"), "w") as f:
+				f.write("{}")
+
+		self.app_fingerprints = OrderedDict([("frappe", "1"), ("erpnext", "2")])
+		self.installed_apps = {"a.local": set(["frappe", "erpnext"]), "b.local": set(["frappe"])}
+		self.migrated = []
+
+		self.stubs = {
+			"get_app_fingerprints": lambda bench_path='.', jobs=1: self.app_fingerprints,
+			"get_installed_apps": lambda sites, bench_path='.', jobs=1: dict((site, self.installed_apps[site]) for site in sites),
+			"migrate_sites": lambda sites, bench_path='.', jobs=1, rolling=False: self.migrated.extend(sites) or [],
+			"run_frappe_cmd": lambda *args, **kwargs: self.migrated.append(args)
+		}
+		self.originals = dict((name, getattr(bench.utils, name)) for name in self.stubs)
+		for name, stub in self.stubs.items():
+			setattr(bench.utils, name, stub)
+		self.frappe_version, bench.FRAPPE_VERSION = bench.FRAPPE_VERSION, 12
+
+	def tearDown(self):
+		for name, original in self.originals.items():
+			setattr(bench.utils, name, original)
+		bench.FRAPPE_VERSION = self.frappe_version
+		shutil.rmtree(self.bench_path, ignore_errors=True)
+
+	def record_migration(self, site, code_fingerprint=None):
+		fingerprint = bench.utils.get_site_fingerprint(self.installed_apps[site], self.app_fingerprints)
+		bench.utils.set_bench_state("migration_fingerprints", {site: fingerprint}, bench_path=self.bench_path)
+		if code_fingerprint:
+			bench.utils.set_bench_state("migrated_code", {site: code_fingerprint}, bench_path=self.bench_path)
+
+	def test_up_to_date_sites_arent_migrated(self):
+		self.record_migration("b.local", bench.utils.get_site_fingerprint(self.app_fingerprints, self.app_fingerprints))
+		bench.utils.patch_sites(bench_path=self.bench_path)
+
+		self.assertEqual(self.migrated, ["a.local"])
+
+	def test_unaffected_sites_arent_migrated(self):
+		# b.local migrated before, with other code, but has none of the changed apps
+		self.record_migration("b.local", "old code")
+		bench.utils.patch_sites(bench_path=self.bench_path, apps=["erpnext"])
+
+		self.assertEqual(self.migrated, ["a.local"])
+
+	def test_all_sites_are_migrated_together(self):
+		bench.utils.patch_sites(bench_path=self.bench_path)
+		self.assertEqual(self.migrated, [("--site", "all", "migrate")])
@@ -0,0 +1,166 @@
+"""Timing traces of bench operations
+
+With BENCH_TRACE set in the environment or `trace` set in common_site_config, bench records
+a span for every command it runs and every major step it takes. When bench exits, the spans are
+written to logs/trace-<timestamp>.jsonl, one JSON object per span, and to
+logs/trace-<timestamp>.json in the Chrome trace format, which chrome://tracing and Perfetto
+can load.
+"""
+
+# imports - standard imports
+import atexit
+import errno
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+spans = []
+spans_lock = threading.Lock()
+trace_settings = {}
+
+
+def is_enabled():
+	with spans_lock:
+		if 'enabled' not in trace_settings:
+			from bench.config.common_site_config import get_config
+
+			trace_settings['enabled'] = bool(os.environ.get('BENCH_TRACE') or get_config('.').get('trace'))
+			trace_settings.setdefault('bench_path', os.path.abspath('.'))
+			if trace_settings['enabled']:
+				atexit.register(write_trace)
+
+	return trace_settings['enabled']
+
+
+def set_bench_path(bench_path):
+	"""Writes the trace into bench_path's logs, for commands that don't run inside the bench
+	such as `bench init`"""
+	trace_settings['bench_path'] = os.path.abspath(bench_path)
+
+
+@contextmanager
+def span(name, category='bench', **args):
+	"""Records how long the block takes. The block may add to the span's args through the dict
+	it gets, such as the exit code of the command it ran"""
+	if not is_enabled():
+		yield {}
+		return
+
+	args.setdefault('cwd', os.getcwd())
+	start = time.time()
+	try:
+		yield args
+	finally:
+		end = time.time()
+		args.setdefault('peak_rss_kb', get_peak_rss(os.getpid()))
+
+		with spans_lock:
+			spans.append({
+				'name': name,
+				'category': category,
+				'start': start,
+				'end': end,
+				'duration': end - start,
+				'pid': os.getpid(),
+				'thread': threading.current_thread().name,
+				'args': args
+			})
+
+
+def traced(func):
+	"""Records a span for every call of the decorated function"""
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		with span(func.__name__, category='step'):
+			return func(*args, **kwargs)
+	return wrapper
+
+
+def wait(process):
+	"""Waits for a Popen process like process.wait(), and also returns its peak RSS in KB when
+	tracing is enabled.
+
+	A child's peak RSS starts out at what it inherited from bench when it was forked, up to
+	bench's own peak. A peak that isn't above bench's is therefore bench's, not the command's, and
+	None is returned for it"""
+	if not (is_enabled() and hasattr(os, 'wait4')):
+		return process.wait(), None
+
+	bench_peak_rss = get_peak_rss(os.getpid())
+
+	while True:
+		try:
+			_, status, rusage = os.wait4(process.pid, 0)
+			break
+		except OSError as e:
+			if e.errno == errno.EINTR:
+				continue
+			if e.errno == errno.ECHILD:
+				# already reaped
+				return process.wait(), None
+			raise
+
+	process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+	peak_rss = to_kb(rusage.ru_maxrss)
+	return process.returncode, peak_rss if peak_rss > bench_peak_rss else None
+
+
+def get_peak_rss(pid):
+	if pid != os.getpid():
+		return None
+
+	import resource
+	return to_kb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def to_kb(maxrss):
+	# ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+	return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+
+def write_trace():
+	with spans_lock:
+		recorded = sorted(spans, key=lambda span: span['start'])
+
+	if not recorded:
+		return
+
+	logs_path = os.path.join(trace_settings['bench_path'], 'logs')
+	if not os.path.isdir(logs_path):
+		return
+
+	trace_file = os.path.join(logs_path, 'trace-{0}'.format(datetime.now().strftime('%Y%m%d_%H%M%S')))
+	threads = {}
+
+	with open(trace_file + '.jsonl', 'w') as f:
+		for span in recorded:
+			f.write(json.dumps(span, sort_keys=True) + '\n')
+
+	with open(trace_file + '.json', 'w') as f:
+		json.dump({
+			'displayTimeUnit': 'ms',
+			'traceEvents': [{
+				'name': span['name'],
+				'cat': span['category'],
+				'ph': 'X',
+				'ts': int(span['start'] * 1e6),
+				'dur': int(span['duration'] * 1e6),
+				'pid': span['pid'],
+				'tid': threads.setdefault(span['thread'], len(threads) + 1),
+				'args': span['args']
+			} for span in recorded] + [{
+				'name': 'thread_name',
+				'ph': 'M',
+				'pid': os.getpid(),
+				'tid': tid,
+				'args': {'name': thread}
+			} for thread, tid in threads.items()]
+		}, f)
+
+	print("Trace written to {0}.json".format(trace_file))
@@ -2,6 +2,7 @@
 import errno
 import glob
 import grp
+import hashlib
 import itertools
 import json
 import logging
@@ -15,17 +16,20 @@ import shutil
 import site
 import subprocess
 import sys
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from distutils.spawn import find_executable
 
 # imports - third party imports
 import click
-import requests
 from six import iteritems
 from six.moves.urllib.parse import urlparse
 
 # imports - module imports
 import bench
+from bench import trace
 
 
 class PatchError(Exception):
@@ -35,6 +39,11 @@ class CommandFailedError(Exception):
 	pass
 
 logger = logging.getLogger(__name__)
+output_lock = threading.Lock()
+update_journal_lock = threading.Lock()
+
+# (step, items, reason) of the work bench skipped, for the summary at the end of an update
+skipped_work = []
 
 folders_in_bench = ('apps', 'sites', 'config', 'logs', 'config/pids')
 
@@ -91,6 +100,7 @@ def get_env_cmd(cmd, bench_path='.'):
 	return os.path.abspath(os.path.join(bench_path, 'env', 'bin', cmd))
 
 
+@trace.traced
 def init(path, apps_path=None, no_procfile=False, no_backups=False,
 		frappe_path=None, frappe_branch=None, verbose=False, clone_from=None,
 		skip_redis_config_generation=False, clone_without_update=False, ignore_exist=False, skip_assets=False,
@@ -117,6 +127,7 @@ def init(path, apps_path=None, no_procfile=False, no_backups=False,
 				pass
 
 	setup_logging()
+	trace.set_bench_path(path)
 
 	setup_env(bench_path=path, python=python)
 
@@ -155,11 +166,13 @@ def init(path, apps_path=None, no_procfile=False, no_backups=False,
 
 
 def update(pull=False, patch=False, build=False, requirements=False, backup=True, force=False, reset=False,
-	restart_supervisor=False, restart_systemd=False):
+	restart_supervisor=False, restart_systemd=False, jobs=None, migrate_all=False, prefetch=False, rolling=False,
+	wave_size=None, staged=False, resume=False):
 	"""command: bench update"""
 	from bench import patches
-	from bench.app import is_version_upgrade, pull_all_apps, validate_branch
+	from bench.app import get_apps, is_version_upgrade, pull_all_apps, validate_branch
 	from bench.config.common_site_config import get_config, update_config
+	from bench.stages import Stage, print_stage_summary, run_stages
 
 	bench_path = os.path.abspath(".")
 	patches.run(bench_path=bench_path)
@@ -169,45 +182,201 @@ def update(pull=False, patch=False, build=False, requirements=False, backup=True
 		print('Release bench detected, cannot update!')
 		sys.exit(1)
 
+	if prefetch:
+		# nothing is applied, so the sites stay up
+		prefetch_updates(bench_path=bench_path, jobs=jobs)
+		return
+
+	del skipped_work[:]
+	journal = get_bench_state('update_journal', bench_path=bench_path)
+	if resume and not journal:
+		log("There is no unfinished update to resume, updating from scratch", level=3)
+	elif resume and journal['options']['staged']:
+		log("Staged updates can't be resumed, updating from scratch", level=3)
+		journal = {}
+	elif journal and not resume:
+		log("The last update didn't finish, updating from scratch. Use `bench update --resume` to continue it instead", level=3)
+		journal = {}
+
+	if journal:
+		# continue with the options of the interrupted update
+		options = journal['options']
+		pull, patch, build, requirements, backup = options['pull'], options['patch'], options['build'], options['requirements'], options['backup']
+		force, reset, migrate_all, rolling, wave_size = options['force'], options['reset'], options['migrate_all'], options['rolling'], options['wave_size']
+		staged = False
+		print("Resuming the update started at {0}".format(datetime.fromtimestamp(journal['started']).strftime('%Y-%m-%d %H:%M:%S')))
+
 	if not (pull or patch or build or requirements):
 		pull, patch, build, requirements = True, True, True, True
 
+	if staged and rolling:
+		log("--staged and --rolling can't be used together", level=2)
+		sys.exit(1)
+
 	validate_branch()
-	version_upgrade = is_version_upgrade()
 
-	if version_upgrade[0]:
-		if force:
-			print("Force flag has been used for a major version change in Frappe and it's apps. \nThis will take significant time to migrate and might break custom apps.")
-		else:
-			print("This update will cause a major version change in Frappe/ERPNext from {0} to {1}. \nThis would take significant time to migrate and might break custom apps.".format(*version_upgrade[1:]))
-			click.confirm('Do you want to continue?', abort=True)
+	if journal:
+		# the pull may have upgraded the apps already
+		version_upgrade = tuple(journal['version_upgrade'])
+	else:
+		version_upgrade = is_version_upgrade()
 
-	if version_upgrade[0] or (not version_upgrade[0] and force):
-		validate_upgrade(version_upgrade[1], version_upgrade[2], bench_path=bench_path)
+		if version_upgrade[0]:
+			if force:
+				print("Force flag has been used for a major version change in Frappe and it's apps. \nThis will take significant time to migrate and might break custom apps.")
+			else:
+				print("This update will cause a major version change in Frappe/ERPNext from {0} to {1}. \nThis would take significant time to migrate and might break custom apps.".format(*version_upgrade[1:]))
+				click.confirm('Do you want to continue?', abort=True)
 
-	conf.update({ "maintenance_mode": 1, "pause_scheduler": 1 })
-	update_config(conf, bench_path=bench_path)
+		if version_upgrade[0] or (not version_upgrade[0] and force):
+			validate_upgrade(version_upgrade[1], version_upgrade[2], bench_path=bench_path)
 
-	if backup:
-		print('Backing up sites...')
-		backup_all_sites(bench_path=bench_path)
+	if rolling and version_upgrade[0]:
+		log("Major version upgrades can't be rolled out site by site, putting the whole bench in maintenance mode", level=3)
+		rolling = False
 
-	if pull:
-		pull_all_apps(bench_path=bench_path, reset=reset)
+	def set_maintenance_mode(enabled):
+		conf.update({ "maintenance_mode": int(enabled), "pause_scheduler": int(enabled) })
+		update_config(conf, bench_path=bench_path)
 
-	if requirements:
-		update_requirements(bench_path=bench_path)
-		update_node_packages(bench_path=bench_path)
+	if rolling:
+		# sites stay up, each one only goes into maintenance mode while it is migrated
+		wave_size = wave_size or conf.get('rolling_wave_size') or jobs or conf.get('migrate_jobs') or 1
+	else:
+		wave_size = None
+
+	if not journal:
+		record_rollback_manifest(bench_path=bench_path)
+		journal = {
+			'started': time.time(),
+			'options': {'pull': pull, 'patch': patch, 'build': build, 'requirements': requirements, 'backup': backup,
+				'force': force, 'reset': reset, 'migrate_all': migrate_all, 'rolling': rolling, 'wave_size': wave_size, 'staged': staged},
+			'version_upgrade': version_upgrade,
+			'stages': {}, 'pulled_apps': {}, 'backed_up_sites': {}, 'migrated_sites': {}
+		}
+		set_bench_state('update_journal', journal, bench_path=bench_path)
+
+	if staged:
+		# the update is applied to a copy of the apps, the sites stay up until it is migrated
+		from bench.deployments import activate_release, prune_releases, setup_release_env, stage_release
+		code_path = stage_release(bench_path=bench_path, jobs=jobs or 1)
+		# patch_sites records the sites it migrates in the release's manifest
+		set_bench_state('rollback_manifest', get_bench_state('rollback_manifest', bench_path=bench_path), bench_path=code_path)
+	elif not rolling:
+		code_path = bench_path
+		set_maintenance_mode(True)
+	else:
+		code_path = bench_path
 
-	if patch:
+	def run_backups():
+		print('Backing up sites...')
+		sites = [site for site in get_sites(bench_path=bench_path) if site not in journal['backed_up_sites']]
+		backup_all_sites(bench_path=bench_path, jobs=jobs, sites=sites)
+		record_backups(bench_path=bench_path)
+
+	def run_pull():
+		from bench.app import get_head_commit
+
+		# apps that were pulled before the update was interrupted and haven't moved since
+		pulled_apps = [app for app, head in journal['pulled_apps'].items()
+			if os.path.isdir(os.path.join(code_path, 'apps', app)) and get_head_commit(app, bench_path=code_path) == head]
+		pull_all_apps(bench_path=code_path, reset=reset, jobs=jobs or 1, skip_apps=pulled_apps)
+
+		changes = get_pulled_changes(bench_path=bench_path, code_path=code_path)
+		if changes:
+			print("Pulled changes in " + ", ".join("{0} ({1}..{2})".format(app, (old or '')[:7], (new or '')[:7])
+				for app, (old, new) in sorted(changes.items())))
+		else:
+			print("The pull didn't change any app")
+
+	def get_changed_apps(step, restrict=True):
+		"""The apps a later stage needs to look at, or all of them if this update doesn't pull"""
+		if not (pull and restrict):
+			return None
+
+		changed_apps = get_apps_to_update(step, bench_path=bench_path, code_path=code_path)
+		unchanged_apps = [app for app in get_apps(bench_path=code_path) if app not in changed_apps]
+		if step and unchanged_apps:
+			record_skipped(step, unchanged_apps, "unchanged by the pull and up to date")
+		return changed_apps
+
+	def run_python_packages():
+		if staged:
+			setup_release_env(code_path, bench_path=bench_path)
+		# a staged release has a fresh env, which needs every app
+		update_requirements(bench_path=code_path, apps=get_changed_apps('python packages', restrict=not staged))
+
+	def run_node_packages():
+		update_node_packages(bench_path=code_path, apps=get_changed_apps('node packages'))
+
+	def run_build():
+		# as do the empty assets of a staged release
+		build_assets(bench_path=code_path, apps=get_changed_apps('build', restrict=not staged))
+
+	def run_migrations():
+		if staged:
+			# the old code must not serve the migrated sites
+			set_maintenance_mode(True)
 		print('Patching sites...')
-		patch_sites(bench_path=bench_path)
+		try:
+			# patch_sites notes the sites it skips itself
+			patch_sites(bench_path=code_path, jobs=jobs, force=migrate_all, wave_size=wave_size, apps=get_changed_apps(None))
+		finally:
+			if staged:
+				record_migrated_sites(get_bench_state('rollback_manifest', bench_path=code_path).get('migrated_sites', []),
+					bench_path=bench_path)
+
+	# backups must not import code that is being pulled, but installing Python and Node packages
+	# can overlap, as can migrations and asset builds. A staged update migrates last, so that the
+	# sites are only in maintenance mode until the release is switched to
+	def journaled(name, func, depends_on_code=True):
+		"""Skips the stage if it finished before the update was interrupted, and the apps are
+		still at the commits it ran with"""
+		def run():
+			inputs = get_code_fingerprint(bench_path=code_path) if depends_on_code else True
+			if journal['stages'].get(name) == inputs:
+				print_line("Skipping {0}, it finished before the update was interrupted".format(name))
+				return
+			func()
+			record_update_progress('stages', name, inputs, bench_path=bench_path)
+		return run
+
+	stages = []
+	if backup:
+		stages.append(Stage('backup', journaled('backup', run_backups, depends_on_code=False)))
+	if pull:
+		stages.append(Stage('pull', journaled('pull', run_pull, depends_on_code=False), requires=[] if staged else ['backup']))
+	if requirements or staged:
+		stages.append(Stage('python packages', journaled('python packages', run_python_packages), requires=['pull']))
+	if requirements:
+		stages.append(Stage('node packages', journaled('node packages', run_node_packages), requires=['pull']))
+	if patch:
+		stages.append(Stage('migrate', journaled('migrate', run_migrations),
+			requires=['backup', 'pull', 'python packages'] + (['build'] if staged else [])))
+	if build or staged:
+		stages.append(Stage('build', journaled('build', run_build),
+			requires=['pull', 'python packages', 'node packages']))
+	if version_upgrade[0] or (not version_upgrade[0] and force):
+		stages.append(Stage('post upgrade', journaled('post upgrade',
+			lambda: post_upgrade(version_upgrade[1], version_upgrade[2], bench_path=bench_path)), requires=['migrate', 'build']))
+
+	try:
+		finished_stages = run_stages(stages)
+	except BaseException:
+		if staged and not conf.get('maintenance_mode'):
+			log("The update failed, the bench is still running its previous release. Removing {0}".format(code_path), level=2)
+			shutil.rmtree(code_path)
+		elif staged:
+			log("The update failed after the sites started migrating, {0} is kept for inspection".format(code_path), level=2)
+		raise
 
-	if build:
-		build_assets(bench_path=bench_path)
+	print_stage_summary(finished_stages)
+	if skipped_work:
+		print_summary_table(('Step', 'Skipped', 'Reason'), skipped_work)
 
-	if version_upgrade[0] or (not version_upgrade[0] and force):
-		post_upgrade(version_upgrade[1], version_upgrade[2], bench_path=bench_path)
+	if staged:
+		activate_release(os.path.basename(code_path), bench_path=bench_path)
+		prune_releases(bench_path=bench_path, keep=conf.get('deployments_to_keep') or 3)
 
 	if restart_supervisor or conf.get('restart_supervisor_on_update'):
 		restart_supervisor_processes(bench_path=bench_path)
@@ -215,10 +384,274 @@ def update(pull=False, patch=False, build=False, requirements=False, backup=True
 	if restart_systemd or conf.get('restart_systemd_on_update'):
 		restart_systemd_processes(bench_path=bench_path)
 
+	if is_process_running(get_bench_state('helper_server', bench_path=bench_path).get('pid')):
+		# the helper server still has the old code loaded
+		stop_helper_server(bench_path=bench_path)
+		start_helper_server(bench_path=bench_path)
+
+	if not rolling:
+		set_maintenance_mode(False)
+
+	set_bench_state('update_journal', {}, bench_path=bench_path)
+
+	print("_" * 80 + "\nBench: Deployment tool for Frappe and Frappe Applications (https://frappe.io/bench).\nOpen source depends on your contributions, so please contribute bug reports, patches, fixes or cash and be a part of the community")
+
+
+def record_skipped(step, items, reason):
+	"""Notes work that was skipped and why, for the summary at the end of an update"""
+	with output_lock:
+		skipped_work.append((step, ", ".join(items), reason))
+
+
+def get_pulled_changes(bench_path='.', code_path=None):
+	"""Returns {app: (old HEAD, new HEAD)} for the apps in code_path whose HEAD moved since the
+	update recorded its rollback manifest, including apps that weren't there"""
+	from bench.app import get_apps, get_head_commit
+
+	code_path = code_path or bench_path
+	manifest_apps = get_bench_state('rollback_manifest', bench_path=bench_path).get('apps', {})
+	changes = {}
+	for app in get_apps(bench_path=code_path):
+		if os.path.isdir(os.path.join(code_path, 'apps', app)):
+			old_head = manifest_apps.get(app, {}).get('commit')
+			new_head = get_head_commit(app, bench_path=code_path)
+			if not old_head or old_head != new_head:
+				changes[app] = (old_head, new_head)
+
+	return changes
+
+
+def get_apps_to_update(step, bench_path='.', code_path=None):
+	"""Returns the apps the update's step needs to look at: those whose HEAD the pull moved, and
+	those the step didn't finish for before, such as an app whose last yarn install failed"""
+	code_path = code_path or bench_path
+	apps = set(get_pulled_changes(bench_path=bench_path, code_path=code_path))
+	if step:
+		apps.update(get_outdated_apps(step, bench_path=code_path))
+
+	return sorted(apps)
+
+
+def get_outdated_apps(step, bench_path='.'):
+	"""Returns the apps whose state recorded by the step ('python packages', 'node packages' or
+	'build') is missing or doesn't match their current sources"""
+	from bench.app import get_apps
+
+	apps = [app for app in get_apps(bench_path=bench_path) if os.path.isdir(os.path.join(bench_path, 'apps', app))]
+
+	if step == 'python packages':
+		installed = get_bench_state('python_requirements', bench_path=bench_path)
+		env_python_version = get_env_python_version(bench_path=bench_path)
+		return [app for app in apps
+			if installed.get(app, {}).get('hash') != get_requirements_hash(app, env_python_version, bench_path=bench_path)]
+
+	elif step == 'node packages':
+		installed = get_bench_state('node_packages', bench_path=bench_path)
+		apps_dir = os.path.join(bench_path, 'apps')
+		return [app for app in apps if os.path.exists(os.path.join(apps_dir, app, 'package.json'))
+			and (installed.get(app) != get_node_packages_hash(os.path.join(apps_dir, app))
+				or not os.path.isdir(os.path.join(apps_dir, app, 'node_modules')))]
+
+	elif step == 'build':
+		built = get_build_fingerprints(bench_path=bench_path)
+		return [app for app in apps if built.get(app) != get_assets_fingerprint(app, bench_path=bench_path)]
+
+	return []
+
+
+def get_code_fingerprint(bench_path='.'):
+	"""Hashes the HEAD commits of the bench's apps"""
+	from bench.app import get_apps, get_head_commit
+
+	fingerprint = hashlib.sha1()
+	for app in sorted(get_apps(bench_path=bench_path)):
+		if os.path.isdir(os.path.join(bench_path, 'apps', app)):
+			fingerprint.update('{0} {1}\n'.format(app, get_head_commit(app, bench_path=bench_path)).encode('utf-8'))
+
+	return fingerprint.hexdigest()
+
+
+def record_update_progress(key, item, value=True, bench_path='.'):
+	"""Records in the journal of an unfinished update that item, a stage, app or site, is done"""
+	with update_journal_lock:
+		journal = get_bench_state('update_journal', bench_path=bench_path)
+		if journal:
+			journal[key][item] = value
+			set_bench_state('update_journal', journal, bench_path=bench_path)
+
+
+def record_rollback_manifest(bench_path='.'):
+	"""Records what `bench rollback` restores: the commit and branch of every app, the packages
+	in env and the fingerprints of the built assets. The update adds the backups it takes and
+	patch_sites the sites it migrates"""
+	from bench.app import get_apps, get_git_metadata
+
+	apps = {}
+	for app in get_apps(bench_path=bench_path):
+		if os.path.isdir(os.path.join(bench_path, 'apps', app)):
+			metadata = get_git_metadata(app, bench_path=bench_path)
+			apps[app] = {'commit': metadata['head'], 'branch': metadata['branch']}
+
+	set_bench_state('rollback_manifest', {
+		'created': time.time(),
+		'apps': apps,
+		'python_packages': get_python_packages(bench_path=bench_path),
+		'assets': get_build_fingerprints(bench_path=bench_path),
+		'backups': {},
+		'migrated_sites': []
+	}, bench_path=bench_path)
+
+
+def record_backups(bench_path='.'):
+	"""Adds the newest database backup of each site, if taken since the rollback manifest was
+	recorded, to the manifest"""
+	manifest = get_bench_state('rollback_manifest', bench_path=bench_path)
+	if not manifest:
+		return
+
+	for site in get_sites(bench_path=bench_path):
+		backups = glob.glob(os.path.join(bench_path, 'sites', site, 'private', 'backups', '*-database.sql.gz'))
+		backups = [path for path in backups if os.path.getmtime(path) >= manifest['created']]
+		if backups:
+			manifest['backups'][site] = os.path.abspath(max(backups, key=os.path.getmtime))
+
+	set_bench_state('rollback_manifest', manifest, bench_path=bench_path)
+
+
+def record_migrated_sites(sites, bench_path='.'):
+	manifest = get_bench_state('rollback_manifest', bench_path=bench_path)
+	if manifest:
+		manifest['migrated_sites'] = sorted(set(manifest['migrated_sites']) | set(sites))
+		set_bench_state('rollback_manifest', manifest, bench_path=bench_path)
+
+
+def get_python_packages(bench_path='.'):
+	"""Returns `pip freeze` of env without the apps, which are installed in editable mode, or
+	None if the packages couldn't be listed"""
+	try:
+		output = subprocess.check_output([get_env_cmd('pip', bench_path=bench_path), 'freeze', '--exclude-editable'])
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+	return sorted(line for line in output.decode('utf-8').splitlines() if line and not line.startswith('#'))
+
+
+def rollback_update(bench_path='.', restore_sites=False, mariadb_root_password=None, jobs=None):
+	"""Restores the apps, env and assets to the rollback manifest recorded by the last update,
+	and with restore_sites, the sites it migrated from the backups it took"""
+	import tempfile
+	from bench.app import get_changed_files, get_head_commit, remove_stale_bytecode
+	from bench.config.common_site_config import get_config, update_config
+
+	bench_path = os.path.abspath(bench_path)
+	manifest = get_bench_state('rollback_manifest', bench_path=bench_path)
+	if not manifest:
+		log("No rollback manifest found, it is recorded by `bench update`", level=2)
+		return False
+
+	conf = get_config(bench_path)
+	jobs = jobs or multiprocessing.cpu_count()
+	conf.update({ "maintenance_mode": 1, "pause_scheduler": 1 })
+	update_config(conf, bench_path=bench_path)
+
+	def reset_app(app):
+		commit, branch = manifest['apps'][app]['commit'], manifest['apps'][app]['branch']
+		repo_dir = os.path.join(bench_path, 'apps', app)
+		if not os.path.isdir(repo_dir):
+			return (app, commit, 'missing')
+
+		old_head = get_head_commit(app, bench_path=bench_path)
+		if old_head == commit:
+			return (app, commit, 'unchanged')
+
+		prefix = "[{0}] ".format(app) if jobs > 1 else None
+		checkout = 'git checkout -q -f -B {0} {1}'.format(branch, commit) if branch else 'git checkout -q -f {0}'.format(commit)
+		if exec_cmd(checkout, cwd=repo_dir, prefix=prefix):
+			return (app, commit, 'failed')
+
+		remove_stale_bytecode(app, get_changed_files(app, old_head, commit, bench_path=bench_path), bench_path=bench_path)
+		return (app, commit, 'restored')
+
+	print('Restoring apps...')
+	results = run_parallel(reset_app, sorted(manifest['apps']), jobs=jobs)
+	print_summary_table(('App', 'Commit', 'Status'), [(app, commit[:7], status) for app, commit, status in results])
+	failed_apps = [app for app, _, status in results if status in ('failed', 'missing')]
+	if failed_apps:
+		log("Couldn't restore {0}, leaving the bench in maintenance mode".format(", ".join(failed_apps)), level=2)
+		return False
+
+	print('Restoring Python packages...')
+	update_requirements(bench_path=bench_path)
+	packages = get_python_packages(bench_path=bench_path)
+	if manifest['python_packages'] is None:
+		log("The packages in env weren't recorded before the update, leaving them as they are", level=3)
+	elif packages is None:
+		log("Couldn't list the packages in env, leaving them as they are", level=3)
+	elif packages != manifest['python_packages']:
+		def get_names(lines):
+			return set(re.split('[=@ ]', line, 1)[0].lower() for line in lines)
+
+		extra_packages = get_names(packages) - get_names(manifest['python_packages'])
+		if extra_packages:
+			exec_cmd('{0} uninstall -q -y {1}'.format(get_env_cmd('pip', bench_path=bench_path), ' '.join(sorted(extra_packages))))
+
+		fd, requirements_file = tempfile.mkstemp(suffix='.txt')
+		with os.fdopen(fd, 'w') as f:
+			f.write('\n'.join(manifest['python_packages']) + '\n')
+		try:
+			exec_cmd('{0} install -q --no-deps {1} -r {2}'.format(get_env_cmd('pip', bench_path=bench_path),
+				get_pip_install_flags(bench_path=bench_path), requirements_file))
+		finally:
+			os.remove(requirements_file)
+
+	print('Restoring assets...')
+	build_assets(bench_path=bench_path)
+
+	if restore_sites:
+		restore_migrated_sites(manifest, bench_path=bench_path, mariadb_root_password=mariadb_root_password)
+	elif manifest['migrated_sites']:
+		log("These sites were migrated by the update and weren't restored: {0}. Use --restore-sites to restore them from the backups taken before the update".format(
+			", ".join(manifest['migrated_sites'])), level=3)
+
+	if conf.get('restart_supervisor_on_update'):
+		restart_supervisor_processes(bench_path=bench_path)
+	if conf.get('restart_systemd_on_update'):
+		restart_systemd_processes(bench_path=bench_path)
+	if is_process_running(get_bench_state('helper_server', bench_path=bench_path).get('pid')):
+		stop_helper_server(bench_path=bench_path)
+		start_helper_server(bench_path=bench_path)
+
 	conf.update({ "maintenance_mode": 0, "pause_scheduler": 0 })
 	update_config(conf, bench_path=bench_path)
+	log("Rolled back to the state before the update", level=1)
+	return True
 
-	print("_" * 80 + "\nBench: Deployment tool for Frappe and Frappe Applications (https://frappe.io/bench).\nOpen source depends on your contributions, so please contribute bug reports, patches, fixes or cash and be a part of the community")
+
+def restore_migrated_sites(manifest, bench_path='.', mariadb_root_password=None):
+	"""Restores the sites the update migrated from the backups it took before migrating them"""
+	migrated_fingerprints = get_bench_state('migration_fingerprints', bench_path=bench_path)
+	migrated_code = get_bench_state('migrated_code', bench_path=bench_path)
+
+	for site in manifest['migrated_sites']:
+		backup = manifest['backups'].get(site)
+		if not (backup and os.path.exists(backup)):
+			log("No backup of {0} was taken by the update, it can't be restored".format(site), level=2)
+			continue
+
+		args = ['--site', site, 'restore', backup]
+		if mariadb_root_password:
+			args.extend(['--mariadb-root-password', mariadb_root_password])
+
+		print('Restoring {0} from {1}...'.format(site, backup))
+		if exec_frappe_cmd(*args, bench_path=bench_path):
+			log("Restoring {0} failed".format(site), level=2)
+		else:
+			# the site's schema is back to what the old code expects
+			migrated_fingerprints.pop(site, None)
+			migrated_code.pop(site, None)
+
+	set_bench_state('migration_fingerprints', migrated_fingerprints, bench_path=bench_path)
+	set_bench_state('migrated_code', migrated_code, bench_path=bench_path)
 
 
 def copy_patches_txt(bench_path):
@@ -226,8 +659,74 @@ def copy_patches_txt(bench_path):
 		os.path.join(bench_path, 'patches.txt'))
 
 
+def prefetch_updates(bench_path='.', jobs=None):
+	"""Fetches the apps' upstream commits and downloads the Python and Node packages they need
+	into the wheelhouse and yarn's cache, without changing the apps. The next `bench update`
+	fast-forwards to the fetched commits and installs from the caches, without waiting on the
+	network while the sites are in maintenance mode"""
+	import tempfile
+	from bench.app import export_app_at_commit, get_changed_files, get_file_at_commit, get_repo_dir, prefetch_apps
+
+	print('Fetching updates...')
+	prefetched = prefetch_apps(bench_path=bench_path, jobs=jobs or 1)
+
+	python_requirements, node_apps = [], []
+	for app, fetched in sorted(prefetched.items()):
+		repo_dir = os.path.abspath(get_repo_dir(app, bench_path=bench_path))
+		changed_files = get_changed_files(app, fetched['head'], fetched['commit'], bench_path=bench_path)
+		if changed_files is not None:
+			changed_files = set(os.path.relpath(path, repo_dir) for path in changed_files)
+
+		if changed_files is None or changed_files & set(['requirements.txt', 'setup.py', 'pyproject.toml', 'setup.cfg']):
+			python_requirements.append(app)
+		if changed_files is None or changed_files & set(['package.json', 'yarn.lock']):
+			node_apps.append(app)
+
+	tmp_path = tempfile.mkdtemp(prefix='bench-prefetch-')
+	try:
+		# pip is upgraded first thing when installing
+		requirements, exported_apps = ['pip'], []
+		for app in python_requirements:
+			# building the app as of the fetched commit gets the dependencies its setup.py or
+			# pyproject.toml declares, besides those in requirements.txt
+			source_path = os.path.join(tmp_path, 'source', app)
+			if export_app_at_commit(app, prefetched[app]['commit'], source_path, bench_path=bench_path):
+				requirements.append(source_path)
+				exported_apps.append(app)
+				if os.path.exists(os.path.join(source_path, 'requirements.txt')):
+					requirements.append('-r {0}'.format(os.path.join(source_path, 'requirements.txt')))
+
+		print('Downloading Python packages for {0}...'.format(", ".join(exported_apps) or "pip"))
+		if build_wheels(requirements, bench_path=bench_path) == 0:
+			# the update can install the packages of these commits without the index
+			set_bench_state('prefetched_packages', dict((app, fetched['commit']) for app, fetched in prefetched.items()
+				if app not in python_requirements or app in exported_apps), bench_path=bench_path)
+		else:
+			set_bench_state('prefetched_packages', {}, bench_path=bench_path)
+
+		if node_apps and find_executable('yarn'):
+			print('Downloading node packages for {0}...'.format(", ".join(node_apps)))
+			for app in node_apps:
+				# install the new package.json and yarn.lock in a scratch directory, which fills yarn's cache
+				app_path = os.path.join(tmp_path, app)
+				os.mkdir(app_path)
+				for filename in ('package.json', 'yarn.lock'):
+					content = get_file_at_commit(app, prefetched[app]['commit'], filename, bench_path=bench_path)
+					if content is not None:
+						with open(os.path.join(app_path, filename), 'wb') as f:
+							f.write(content)
+
+				if os.path.exists(os.path.join(app_path, 'package.json')):
+					with yarn_cache_lock(get_yarn_cache_folder(bench_path=bench_path)):
+						exec_cmd(get_yarn_install_command(bench_path=bench_path) + ' --ignore-scripts', cwd=app_path)
+	finally:
+		shutil.rmtree(tmp_path)
+
+	log("Fetched updates for {0}. Run `bench update` to apply them".format(", ".join(sorted(prefetched)) or "no apps"), level=1)
+
+
 def clone_apps_from(bench_path, clone_from, update_app=True):
-	from .app import install_app
+	from .app import clear_git_metadata_cache, fetch_from_git_mirror, install_app
 	print('Copying apps from {0}...'.format(clone_from))
 	subprocess.check_output(['cp', '-R', os.path.join(clone_from, 'apps'), bench_path])
 
@@ -252,7 +751,9 @@ def clone_apps_from(bench_path, clone_from, update_app=True):
 			print('Cleaning up {0}'.format(app))
 			branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], cwd=app_path).strip()
 			subprocess.check_output(['git', 'reset', '--hard'], cwd=app_path)
+			fetch_from_git_mirror(app, remote, bench_path=bench_path)
 			subprocess.check_output(['git', 'pull', '--rebase', remote, branch], cwd=app_path)
+			clear_git_metadata_cache(app_path)
 
 		install_app(app, bench_path)
 
@@ -263,11 +764,66 @@ def clone_apps_from(bench_path, clone_from, update_app=True):
 		setup_app(app)
 
 
-def exec_cmd(cmd, cwd='.'):
+def exec_cmd(cmd, cwd='.', prefix=None):
+	"""Runs cmd and returns its exit code. If prefix is given, every line of output is printed
+	with that prefix, which keeps the output of commands run in parallel apart"""
 	import shlex
-	print("{0}$ {1}{2}".format(color.silver, cmd, color.nc))
-	cmd = shlex.split(cmd)
-	return subprocess.call(cmd, cwd=cwd, universal_newlines=True)
+	print_line("{0}$ {1}{2}".format(color.silver, cmd, color.nc), prefix=prefix)
+
+	with trace.span(cmd, category='exec', cwd=os.path.abspath(cwd)) as span:
+		try:
+			if prefix:
+				p = subprocess.Popen(shlex.split(cmd), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+				print_prefixed_output(p.stdout, prefix)
+			else:
+				p = subprocess.Popen(shlex.split(cmd), cwd=cwd, universal_newlines=True)
+
+			span['exit_code'], span['peak_rss_kb'] = trace.wait(p)
+		finally:
+			if cmd.startswith('git '):
+				# the command may have moved HEAD or changed remotes. Cleared once it's done, so
+				# that metadata read by another thread while it ran doesn't outlive it
+				from bench.app import clear_git_metadata_cache
+				clear_git_metadata_cache(cwd)
+
+	return p.returncode
+
+
+def print_line(line, prefix=None):
+	with output_lock:
+		sys.stdout.write((prefix or '') + line + '\n')
+		sys.stdout.flush()
+
+
+def print_prefixed_output(stream, prefix):
+	for line in iter(stream.readline, ''):
+		print_line(line.rstrip('\n'), prefix=prefix)
+	stream.close()
+
+
+def run_parallel(func, items, jobs=1):
+	"""Returns [func(item) for item in items], running up to `jobs` calls at a time in threads"""
+	items = list(items)
+	if jobs <= 1 or len(items) <= 1:
+		return [func(item) for item in items]
+
+	from multiprocessing.pool import ThreadPool
+	pool = ThreadPool(min(jobs, len(items)))
+	try:
+		return pool.map(func, items)
+	finally:
+		pool.close()
+		pool.join()
+
+
+def print_summary_table(headers, rows):
+	widths = [max(len(str(value)) for value in column) for column in zip(headers, *rows)]
+	row_format = "  ".join("{%d:<%d}" % (i, width) for i, width in enumerate(widths))
+
+	print(row_format.format(*headers))
+	print("  ".join("-" * width for width in widths))
+	for row in rows:
+		print(row_format.format(*[str(value) for value in row]))
 
 
 def which(executable, raise_err = False):
@@ -293,13 +849,14 @@ def get_venv_path():
 
 	return venv or log("virtualenv cannot be found", level=2)
 
+@trace.traced
 def setup_env(bench_path='.', python='python3'):
 	frappe = os.path.join(bench_path, "apps", "frappe")
 	pip = os.path.join(".", "env", "bin", "pip")
 	virtualenv = get_venv_path()
 
 	exec_cmd('{} -q env -p {}'.format(virtualenv, python), cwd=bench_path)
-	exec_cmd('{} install -q -U -e {}'.format(pip, frappe), cwd=bench_path)
+	exec_cmd('{} install -q -U {} -e {}'.format(pip, get_pip_install_flags(bench_path=bench_path), frappe), cwd=bench_path)
 
 
 def setup_socketio(bench_path='.'):
@@ -307,28 +864,315 @@ def setup_socketio(bench_path='.'):
 		babel-cli babel-preset-es2015 babel-preset-es2016 babel-preset-es2017 babel-preset-babili", cwd=bench_path)
 
 
-def patch_sites(bench_path='.'):
+@trace.traced
+def patch_sites(bench_path='.', jobs=None, force=False, wave_size=None, apps=None):
+	"""Migrates the bench's sites, skipping those whose migration fingerprint hasn't changed
+	since their last successful migration unless force is set. With wave_size, the sites are
+	migrated that many at a time, each in maintenance mode only while it is migrated. If apps
+	is given, only the sites that have one of them installed are migrated"""
+	from bench.config.common_site_config import get_config
+
 	bench.set_frappe_version(bench_path=bench_path)
+	jobs = jobs or get_config(bench_path=bench_path).get('migrate_jobs') or 1
 
 	try:
 		if bench.FRAPPE_VERSION == 4:
 			exec_cmd("{frappe} --latest all".format(frappe=get_frappe(bench_path=bench_path)), cwd=os.path.join(bench_path, 'sites'))
+			return
+
+		all_sites = sites = sorted(get_sites(bench_path=bench_path))
+		migrated_fingerprints = get_bench_state('migration_fingerprints', bench_path=bench_path)
+		migrated_code = get_bench_state('migrated_code', bench_path=bench_path)
+		app_fingerprints = get_app_fingerprints(bench_path=bench_path, jobs=jobs)
+		code_fingerprint = get_site_fingerprint(app_fingerprints, app_fingerprints)
+
+		if not force:
+			# none of the bench's apps changed since these sites last migrated, so there's no
+			# need to start frappe to list their apps
+			up_to_date_sites = [site for site in sites if site in migrated_fingerprints and migrated_code.get(site) == code_fingerprint]
+			if up_to_date_sites:
+				log("Skipping migrate for sites migrated since the bench's apps last changed: {0}".format(", ".join(up_to_date_sites)))
+				record_skipped('migrate', up_to_date_sites, "migrated since their apps last changed")
+			sites = [site for site in sites if site not in up_to_date_sites]
+
+		installed_apps = get_installed_apps(sites, bench_path=bench_path, jobs=jobs)
+		fingerprints = dict((site, get_site_fingerprint(installed_apps[site], app_fingerprints)) for site in sites)
+
+		if apps is not None and not force:
+			# a site that was migrated before and has none of the apps installed is up to date.
+			# Sites whose apps couldn't be listed are left to the fingerprint check
+			unaffected_sites = [site for site in sites if site in migrated_fingerprints
+				and installed_apps[site] is not None and not installed_apps[site] & set(apps)]
+			if unaffected_sites:
+				log("Skipping migrate for sites that have none of the changed apps installed: {0}".format(", ".join(unaffected_sites)))
+				record_skipped('migrate', unaffected_sites, "none of their apps changed")
+
+				for site in unaffected_sites:
+					if fingerprints[site] == migrated_fingerprints[site]:
+						migrated_code[site] = code_fingerprint
+				set_bench_state('migrated_code', migrated_code, bench_path=bench_path)
+			sites = [site for site in sites if site not in unaffected_sites]
+
+		if force:
+			# except those the unfinished update already migrated with the same code
+			migrated_sites = get_bench_state('update_journal', bench_path=bench_path).get('migrated_sites', {})
+			pending_sites = [site for site in sites if not fingerprints[site] or fingerprints[site] != migrated_sites.get(site)]
+		else:
+			pending_sites = [site for site in sites if not fingerprints[site] or fingerprints[site] != migrated_fingerprints.get(site)]
+
+		skipped_sites = [site for site in sites if site not in pending_sites]
+		if skipped_sites:
+			log("Skipping migrate for sites whose apps haven't changed since their last migration: {0}".format(", ".join(skipped_sites)))
+			record_skipped('migrate', skipped_sites, "migrated since their apps last changed")
+
+			# so that the next run doesn't have to list their apps either
+			for site in skipped_sites:
+				migrated_code[site] = code_fingerprint
+			set_bench_state('migrated_code', migrated_code, bench_path=bench_path)
+
+		if not pending_sites:
+			return
+
+		record_migrated_sites(pending_sites, bench_path=bench_path)
+
+		if wave_size:
+			failed_sites = migrate_sites(pending_sites, bench_path=bench_path, jobs=wave_size, rolling=True)
+		elif jobs > 1 or pending_sites != all_sites:
+			# `--site all` would migrate the sites skipped above as well
+			failed_sites = migrate_sites(pending_sites, bench_path=bench_path, jobs=jobs)
 		else:
 			run_frappe_cmd('--site', 'all', 'migrate', bench_path=bench_path)
+			failed_sites = []
+
+		for site in pending_sites:
+			if site in failed_sites:
+				# so that the site isn't taken as up to date until it migrates
+				migrated_fingerprints.pop(site, None)
+				migrated_code.pop(site, None)
+			elif fingerprints[site]:
+				migrated_fingerprints[site] = fingerprints[site]
+				migrated_code[site] = code_fingerprint
+				record_update_progress('migrated_sites', site, fingerprints[site], bench_path=bench_path)
+		set_bench_state('migration_fingerprints', migrated_fingerprints, bench_path=bench_path)
+		set_bench_state('migrated_code', migrated_code, bench_path=bench_path)
+
+		if failed_sites:
+			raise PatchError
 	except subprocess.CalledProcessError:
 		raise PatchError
 
 
-def build_assets(bench_path='.', app=None):
+def get_installed_apps(sites, bench_path='.', jobs=1):
+	"""Returns the set of apps installed on each site, or None for sites whose apps couldn't be
+	listed"""
+	def get_site_apps(site):
+		try:
+			output = get_frappe_cmd_output('--site', site, 'list-apps', bench_path=bench_path)
+		except subprocess.CalledProcessError:
+			return (site, None)
+
+		# newer versions of list-apps print the version and branch after the app name
+		return (site, set(line.split()[0] for line in output.decode('utf-8').splitlines() if line.strip()))
+
+	return dict(run_parallel(get_site_apps, sites, jobs=jobs))
+
+
+def get_app_fingerprints(bench_path='.', jobs=1):
+	"""Returns the fingerprint of every app in the bench, in the order of apps.txt. See
+	get_app_fingerprint"""
+	from collections import OrderedDict
+	from bench.app import get_apps
+
+	apps = [app for app in get_apps(bench_path=bench_path) if os.path.isdir(os.path.join(bench_path, 'apps', app))]
+	return OrderedDict(run_parallel(lambda app: (app, get_app_fingerprint(app, bench_path=bench_path)), apps, jobs=jobs))
+
+
+def get_site_fingerprint(site_apps, app_fingerprints):
+	"""Returns a fingerprint of the code a site's migration depends on, made of the fingerprints
+	of the apps installed on it, or None if its installed apps are unknown"""
+	if site_apps is None:
+		return None
+
+	fingerprint = hashlib.sha1()
+	for app in app_fingerprints:
+		if app in site_apps:
+			fingerprint.update('{0} {1}\n'.format(app, app_fingerprints[app]).encode('utf-8'))
+	return fingerprint.hexdigest()
+
+
+def get_app_fingerprint(app, bench_path='.'):
+	"""Hashes an app's HEAD commit along with its patches.txt and the JSON files migrate syncs
+	(doctypes, reports, fixtures...), so uncommitted changes to them count as well"""
+	from bench.app import get_head_commit
+
+	module_path = os.path.join(bench_path, 'apps', app, app)
+	fingerprint = hashlib.sha1()
+	fingerprint.update('{0}\n'.format(get_head_commit(app, bench_path=bench_path)).encode('utf-8'))
+
+	schema_files = [os.path.join(module_path, 'patches.txt')]
+	for root, dirs, files in os.walk(module_path):
+		dirs[:] = sorted(d for d in dirs if d not in ('public', 'node_modules') and not d.startswith('.'))
+		schema_files.extend(os.path.join(root, f) for f in sorted(files) if f.endswith('.json'))
+
+	for path in schema_files:
+		try:
+			with open(path, 'rb') as f:
+				content = f.read()
+		except IOError:
+			continue
+		fingerprint.update(os.path.relpath(path, module_path).encode('utf-8'))
+		fingerprint.update(hashlib.sha1(content).digest())
+
+	return fingerprint.hexdigest()
+
+
+def migrate_sites(sites, bench_path='.', jobs=1, rolling=False):
+	"""Migrates sites `jobs` at a time, each in its own frappe process. A failed migration
+	doesn't stop the others; the sites that failed are reported and returned.
+
+	If rolling is set, each site is put in maintenance mode through its site_config.json for
+	the duration of its migration. Sites whose migration failed stay in maintenance mode"""
+	from bench.config.site_config import get_site_config, update_site_config
+
+	sites = list(sites)
+	progress = {'completed': 0}
+
+	def migrate(site):
+		prefix = "[{0}] ".format(site) if jobs > 1 else None
+		# leave sites that were put in maintenance mode by hand as they are
+		maintenance_mode = rolling and not get_site_config(site, bench_path=bench_path).get('maintenance_mode')
+		if maintenance_mode:
+			update_site_config(site, {'maintenance_mode': 1, 'pause_scheduler': 1}, bench_path=bench_path)
+
+		start = time.time()
+		return_code = exec_frappe_cmd('--site', site, 'migrate', bench_path=bench_path, prefix=prefix)
+		status = 'failed' if return_code else 'migrated'
+
+		if maintenance_mode and not return_code:
+			update_site_config(site, {'maintenance_mode': 0, 'pause_scheduler': 0}, bench_path=bench_path)
+		duration = '{0:.1f}s'.format(time.time() - start)
+
+		with output_lock:
+			progress['completed'] += 1
+			log("[{0}/{1}] {2} {3} in {4}".format(progress['completed'], len(sites), site, status, duration),
+				level=2 if return_code else 1)
+
+		return (site, status, duration)
+
+	results = run_parallel(migrate, sites, jobs=jobs)
+	print_summary_table(('Site', 'Migration', 'Time'), results)
+
+	failed_sites = [site for site, status, _ in results if status == 'failed']
+	if failed_sites:
+		log("Migration failed for the following sites, they need attention: {0}".format(", ".join(failed_sites)), level=2)
+		if rolling:
+			log("They were left in maintenance mode, turn it off with `bench --site <site> set-maintenance-mode off` once they are fixed", level=3)
+
+	return failed_sites
+
+
+@trace.traced
+def build_assets(bench_path='.', app=None, force=False, apps=None):
+	"""Builds the assets of the apps whose sources changed since their last successful build,
+	or of every app if force is set. A change in frappe, which ships the build tooling,
+	rebuilds all apps. If apps is given, only those apps are looked at, unless frappe is one
+	of them"""
+	from bench.app import get_apps
+	from bench.config.common_site_config import get_config
+
 	bench.set_frappe_version(bench_path=bench_path)
 
 	if bench.FRAPPE_VERSION == 4:
 		exec_cmd("{frappe} --build".format(frappe=get_frappe(bench_path=bench_path)), cwd=os.path.join(bench_path, 'sites'))
+		return
+
+	built = get_build_fingerprints(bench_path=bench_path)
+	if app:
+		apps = [app]
+	elif apps is None or 'frappe' in apps:
+		apps = get_apps(bench_path=bench_path)
 	else:
-		command = 'bench build'
-		if app:
-			command += ' --app {}'.format(app)
-		exec_cmd(command, cwd=bench_path)
+		apps = [app_name for app_name in get_apps(bench_path=bench_path) if app_name in apps]
+	fingerprints = dict((app_name, get_assets_fingerprint(app_name, bench_path=bench_path)) for app_name in apps)
+
+	changed_apps = [app_name for app_name in apps if force or built.get(app_name) != fingerprints[app_name]]
+	if not changed_apps:
+		if apps:
+			log("Assets of {0} haven't changed since they were last built, skipping build".format(", ".join(apps)))
+			record_skipped('build', apps, "assets haven't changed")
+		return
+
+	if not app and 'frappe' in changed_apps:
+		built_apps = apps if exec_cmd('bench build', cwd=bench_path) == 0 else []
+	else:
+		skipped_apps = [app_name for app_name in apps if app_name not in changed_apps]
+		if skipped_apps:
+			log("Skipping build for apps whose assets haven't changed: {0}".format(", ".join(skipped_apps)))
+			record_skipped('build', skipped_apps, "assets haven't changed")
+
+		jobs = get_config(bench_path=bench_path).get('build_jobs') or 1
+
+		def build(app_name):
+			prefix = "[{0}] ".format(app_name) if jobs > 1 else None
+			return (app_name, exec_cmd('bench build --app {0}'.format(app_name), cwd=bench_path, prefix=prefix))
+
+		built_apps = [app_name for app_name, return_code in run_parallel(build, changed_apps, jobs=jobs) if return_code == 0]
+
+	for app_name in built_apps:
+		built[app_name] = fingerprints[app_name]
+	set_build_fingerprints(built, bench_path=bench_path)
+
+
+def get_build_fingerprints(bench_path='.'):
+	"""Returns the fingerprints of the apps whose assets are built into sites/assets. They are
+	kept in config/, where the webserver can't serve them, along with the mtime sites/assets had
+	when they were recorded, so that they no longer count once sites/assets is cleared or
+	replaced"""
+	state = get_bench_state('build_fingerprints', bench_path=bench_path)
+	if not state or state.get('assets_mtime') != get_assets_mtime(bench_path=bench_path):
+		return {}
+	return state['apps']
+
+
+def set_build_fingerprints(fingerprints, bench_path='.'):
+	# older versions of bench kept the fingerprints in sites/assets, where they were served
+	legacy_file = os.path.join(bench_path, 'sites', 'assets', 'build_fingerprints.json')
+	if os.path.exists(legacy_file):
+		os.remove(legacy_file)
+
+	set_bench_state('build_fingerprints', {'apps': fingerprints, 'assets_mtime': get_assets_mtime(bench_path=bench_path)},
+		bench_path=bench_path)
+
+
+def get_assets_mtime(bench_path='.'):
+	try:
+		return os.path.getmtime(os.path.join(bench_path, 'sites', 'assets'))
+	except OSError:
+		return None
+
+
+def get_assets_fingerprint(app, bench_path='.'):
+	"""Hashes the sources of an app's assets: its public folder, except the bundles built into
+	it, and the package.json and yarn.lock of its node dependencies"""
+	app_path = os.path.join(bench_path, 'apps', app)
+	public_path = os.path.join(app_path, app, 'public')
+	source_files = [os.path.join(app_path, 'package.json'), os.path.join(app_path, 'yarn.lock')]
+
+	for root, dirs, files in os.walk(public_path, followlinks=True):
+		dirs[:] = sorted(d for d in dirs if d not in ('node_modules', 'dist') and not d.startswith('.'))
+		source_files.extend(os.path.join(root, f) for f in sorted(files))
+
+	fingerprint = hashlib.sha1()
+	for path in source_files:
+		try:
+			with open(path, 'rb') as f:
+				content = f.read()
+		except IOError:
+			continue
+		fingerprint.update(os.path.relpath(path, app_path).encode('utf-8'))
+		fingerprint.update(hashlib.sha1(content).digest())
+
+	return fingerprint.hexdigest()
 
 
 def get_sites(bench_path='.'):
@@ -341,6 +1185,7 @@ def get_bench_dir(bench_path='.'):
 	return os.path.abspath(bench_path)
 
 
+@trace.traced
 def setup_backups(bench_path='.'):
 	logger.info('setting up backups')
 	bench_dir = get_bench_dir(bench_path=bench_path)
@@ -470,6 +1315,22 @@ def get_git_version():
 	return float(version)
 
 
+def get_clone_strategy(bench_path='.'):
+	"""Returns how apps are cloned, `clone_strategy` in common_site_config: `full`, `shallow`
+	(only the latest commit) or `blobless` (full history, file contents fetched when checked out,
+	needs git 2.19+). Without it, `shallow_clone` decides between shallow and full clones"""
+	from .config.common_site_config import get_config
+	config = get_config(bench_path)
+
+	if config.get('release_bench'):
+		return 'full'
+
+	if config.get('clone_strategy') in ('full', 'shallow', 'blobless'):
+		return config['clone_strategy']
+
+	return 'shallow' if check_git_for_shallow_clone() else 'full'
+
+
 def check_git_for_shallow_clone():
 	from .config.common_site_config import get_config
 	config = get_config('.')
@@ -487,14 +1348,16 @@ def check_git_for_shallow_clone():
 
 
 def get_cmd_output(cmd, cwd='.'):
-	try:
-		output = subprocess.check_output(cmd, cwd=cwd, shell=True, stderr=subprocess.PIPE).strip()
-		output = output.decode('utf-8')
-		return output
-	except subprocess.CalledProcessError as e:
-		if e.output:
-			print(e.output)
-		raise
+	with trace.span(cmd, category='exec', cwd=os.path.abspath(cwd), exit_code=0, peak_rss_kb=None) as span:
+		try:
+			output = subprocess.check_output(cmd, cwd=cwd, shell=True, stderr=subprocess.PIPE).strip()
+			output = output.decode('utf-8')
+			return output
+		except subprocess.CalledProcessError as e:
+			span['exit_code'] = e.returncode
+			if e.output:
+				print(e.output)
+			raise
 
 
 def safe_encode(what, encoding = 'utf-8'):
@@ -551,22 +1414,203 @@ def set_default_site(site, bench_path='.'):
 
 
 def update_env_pip(bench_path):
-	env_pip = os.path.join(bench_path, 'env', 'bin', 'pip')
-	exec_cmd("{pip} install -q -U pip".format(pip=env_pip))
+	from bench.app import get_apps
+	exec_pip_install("-q -U pip", bench_path=bench_path, apps=get_apps(bench_path=bench_path))
+
+
+def get_wheelhouse_path(bench_path='.'):
+	"""Returns the directory of prebuilt wheels shared by the benches on this host"""
+	from bench.config.common_site_config import get_config
+
+	path = (get_config(bench_path=bench_path).get('wheelhouse_path') or os.environ.get('BENCH_WHEELHOUSE')
+		or os.path.join('~', '.bench', 'wheelhouse'))
+	return os.path.abspath(os.path.expanduser(path))
 
 
-def update_requirements(bench_path='.'):
-	from bench.app import get_apps, install_app
+def get_pip_install_flags(bench_path='.'):
+	"""Returns the flags that let pip install from the wheelhouse, if there is one. With
+	wheelhouse_offline set pip installs only from the wheelhouse, without going to the index"""
+	from bench.config.common_site_config import get_config
+
+	wheelhouse = get_wheelhouse_path(bench_path=bench_path)
+	if not os.path.isdir(wheelhouse):
+		return ''
+
+	flags = '--find-links {0}'.format(wheelhouse)
+	if get_config(bench_path=bench_path).get('wheelhouse_offline') or os.environ.get('BENCH_WHEELHOUSE_OFFLINE'):
+		flags += ' --no-index'
+	return flags
+
+
+def exec_pip_install(args, bench_path='.', apps=()):
+	"""Runs `pip install args` in the bench's env and returns pip's exit code. When a prefetch
+	downloaded the packages the apps need at their current commits, pip first installs from the
+	wheelhouse alone, and only goes to the index for packages it's missing"""
+	pip = get_env_cmd('pip', bench_path=bench_path)
+	flags = get_pip_install_flags(bench_path=bench_path)
+
+	if apps and '--no-index' not in flags and are_packages_prefetched(apps, bench_path=bench_path):
+		if exec_cmd("{0} install {1} --no-index {2}".format(pip, flags, args)) == 0:
+			return 0
+		log("Some packages aren't in the wheelhouse, installing them from the index", level=3)
+
+	return exec_cmd("{0} install {1} {2}".format(pip, flags, args))
+
+
+def are_packages_prefetched(apps, bench_path='.'):
+	"""Returns whether the last prefetch downloaded the Python packages of the apps as they
+	are checked out"""
+	from bench.app import get_head_commit
+
+	prefetched = get_bench_state('prefetched_packages', bench_path=bench_path)
+	return all(prefetched.get(app) and prefetched[app] == get_head_commit(app, bench_path=bench_path) for app in apps)
+
+
+def build_wheelhouse(bench_path='.', apps=None):
+	"""Builds wheels for the requirements of the bench's apps into the wheelhouse. Returns pip's
+	exit code"""
+	from bench.app import get_apps
+
+	requirements = ['pip', 'setuptools', 'wheel']
+	for app in apps or get_apps(bench_path=bench_path):
+		app_path = os.path.abspath(os.path.join(bench_path, 'apps', app))
+		req_file = os.path.join(app_path, 'requirements.txt')
+		requirements.append('-r {0}'.format(req_file) if os.path.exists(req_file) else app_path)
+
+	return build_wheels(requirements, bench_path=bench_path)
+
+
+def build_wheels(requirements, bench_path='.'):
+	"""Builds wheels for the given pip requirement arguments into the wheelhouse, with the
+	bench's env so that they match its Python. Returns pip's exit code"""
+	wheelhouse = get_wheelhouse_path(bench_path=bench_path)
+	makedirs_safe(wheelhouse)
+
+	# benches on the host share the wheelhouse, don't let their builds overwrite each other
+	with file_lock(os.path.join(wheelhouse, '.lock')):
+		return exec_cmd("{pip} wheel -q --wheel-dir {wheelhouse} --find-links {wheelhouse} {requirements}".format(
+			pip=get_env_cmd('pip', bench_path=bench_path), wheelhouse=wheelhouse, requirements=' '.join(requirements)))
+
+
+def prune_wheelhouse(bench_path='.', keep=1):
+	"""Removes all but the newest `keep` versions of each package from the wheelhouse, per
+	Python version and platform the wheels were built for"""
+	from distutils.version import LooseVersion
+
+	wheelhouse = get_wheelhouse_path(bench_path=bench_path)
+	if not os.path.isdir(wheelhouse):
+		log("No wheelhouse found at {0}".format(wheelhouse))
+		return
+
+	with file_lock(os.path.join(wheelhouse, '.lock')):
+		wheels = {}
+		for filename in os.listdir(wheelhouse):
+			# {name}-{version}(-{build})?-{python}-{abi}-{platform}.whl
+			parts = filename[:-len('.whl')].split('-')
+			if filename.endswith('.whl') and len(parts) >= 5:
+				wheels.setdefault((parts[0].lower(),) + tuple(parts[-3:]), []).append(filename)
+
+		removed = 0
+		for filenames in wheels.values():
+			try:
+				filenames.sort(key=lambda filename: LooseVersion(filename.split('-')[1]), reverse=True)
+			except TypeError:
+				# versions LooseVersion can't compare, go by when they were built
+				filenames.sort(key=lambda filename: os.path.getmtime(os.path.join(wheelhouse, filename)), reverse=True)
+
+			for filename in filenames[keep:]:
+				os.remove(os.path.join(wheelhouse, filename))
+				removed += 1
+
+	log("Removed {0} wheels from {1}".format(removed, wheelhouse), level=1)
+
+
+@trace.traced
+def update_requirements(bench_path='.', force=False, apps=None):
+	"""Reinstalls the apps whose requirements changed since they were last installed, or every
+	app if force is set. If apps is given, the other apps are left alone"""
+	from bench.app import get_apps, install_app, install_apps
+	from bench.config.common_site_config import get_config
 	print('Updating Python libraries...')
 
-	# update env pip
-	update_env_pip(bench_path)
+	installed = get_bench_state('python_requirements', bench_path=bench_path)
+	env_python_version = get_env_python_version(bench_path=bench_path)
+	all_apps = get_apps(bench_path=bench_path)
+	apps = [app for app in all_apps if apps is None or app in apps]
+
+	requirements_hashes = dict((app, get_requirements_hash(app, env_python_version, bench_path=bench_path)) for app in apps)
+	pending_apps = [app for app in apps if force or installed.get(app, {}).get('hash') != requirements_hashes[app]]
+	skipped_apps = [app for app in apps if app not in pending_apps]
+
+	if pending_apps:
+		# update env pip
+		update_env_pip(bench_path)
+
+	state = dict((app, installed[app]) for app in all_apps if app in installed and app not in pending_apps)
+	if pending_apps and get_config(bench_path=bench_path).get('pip_batch_install'):
+		start = time.time()
+		failed_apps = install_apps(pending_apps, bench_path=bench_path)
+		duration = round((time.time() - start) / len(pending_apps), 1)
+		for app in pending_apps:
+			if app not in failed_apps:
+				state[app] = {'hash': requirements_hashes[app], 'duration': duration}
+		set_bench_state('python_requirements', state, bench_path=bench_path)
+
+	else:
+		for app in pending_apps:
+			start = time.time()
+			if install_app(app, bench_path=bench_path, skip_assets=True, postprocess=False) == 0:
+				state[app] = {'hash': requirements_hashes[app], 'duration': round(time.time() - start, 1)}
+			set_bench_state('python_requirements', state, bench_path=bench_path)
+
+	if skipped_apps:
+		time_saved = sum(installed[app].get('duration', 0) for app in skipped_apps)
+		log("Requirements of {0} haven't changed, skipped installing them (saved ~{1:.1f}s). Use `bench setup requirements --force` to reinstall them".format(
+			", ".join(skipped_apps), time_saved))
+		record_skipped('python packages', skipped_apps, "requirements haven't changed")
+
 
-	for app in get_apps():
-		install_app(app, bench_path=bench_path, skip_assets=True, postprocess=False)
+def get_requirements_hash(app, env_python_version, bench_path='.'):
+	"""Hashes the files that declare an app's dependencies along with the env's Python"""
+	requirements_hash = hashlib.sha1(env_python_version.encode('utf-8'))
 
+	for filename in ('setup.py', 'requirements.txt', 'pyproject.toml', 'setup.cfg'):
+		path = os.path.join(bench_path, 'apps', app, filename)
+		if os.path.exists(path):
+			with open(path, 'rb') as f:
+				requirements_hash.update(filename.encode('utf-8') + b'\0' + hashlib.sha1(f.read()).digest())
 
-def update_node_packages(bench_path='.'):
+	return requirements_hash.hexdigest()
+
+
+def compile_python_files(files, bench_path='.'):
+	"""Compiles the given files to bytecode with the env's Python, over all CPUs where the
+	env's compileall supports it. Returns compileall's exit code"""
+	command = [get_env_cmd('python', bench_path=bench_path), '-m', 'compileall', '-q', '-i', '-']
+	if not os.path.exists(command[0]):
+		return 1
+
+	if not get_env_python_version(bench_path=bench_path).startswith('2.'):
+		command[3:3] = ['-j', '0']
+
+	p = subprocess.Popen(command, stdin=subprocess.PIPE, universal_newlines=True)
+	p.communicate('\n'.join(files))
+	return p.returncode
+
+
+def get_env_python_version(bench_path='.'):
+	"""Returns the version of the env's Python, along with when the env was created so that
+	a recreated env doesn't count as already having the apps installed"""
+	env_python = get_env_cmd('python', bench_path=bench_path)
+	try:
+		version = subprocess.check_output([env_python, '-c', 'import sys; print(sys.version)'], universal_newlines=True)
+		return '{0} {1}'.format(version.strip(), os.lstat(env_python).st_mtime)
+	except (OSError, subprocess.CalledProcessError):
+		return ''
+
+
+@trace.traced
+def update_node_packages(bench_path='.', force=False, apps=None):
 	print('Updating node packages...')
 	from bench.app import get_develop_version
 	from distutils.version import LooseVersion
@@ -575,12 +1619,18 @@ def update_node_packages(bench_path='.'):
 	# After rollup was merged, frappe_version = 10.1
 	# if develop_verion is 11 and up, only then install yarn
 	if v < LooseVersion('11.x.x-develop'):
-		update_npm_packages(bench_path)
+		update_npm_packages(bench_path, force=force)
 	else:
-		update_yarn_packages(bench_path)
+		update_yarn_packages(bench_path, force=force, apps=apps)
 
 
-def update_yarn_packages(bench_path='.'):
+def update_yarn_packages(bench_path='.', force=False, apps=None):
+	"""Runs `yarn install` for the apps whose package.json or yarn.lock changed since their
+	last install. If apps is given, the other apps are left alone.
+
+	The installs run one at a time: yarn v1 can't install into one cache from several processes,
+	and a cache of their own would make each install start cold instead of using the cache the
+	benches on the host and `bench update --prefetch` fill"""
 	apps_dir = os.path.join(bench_path, 'apps')
 
 	if not find_executable('yarn'):
@@ -588,13 +1638,71 @@ def update_yarn_packages(bench_path='.'):
 		print("`npm install -g yarn`")
 		return
 
-	for app in os.listdir(apps_dir):
-		app_path = os.path.join(apps_dir, app)
-		if os.path.exists(os.path.join(app_path, 'package.json')):
-			exec_cmd('yarn install', cwd=app_path)
+	installed = get_bench_state('node_packages', bench_path=bench_path)
+	apps = sorted(app for app in os.listdir(apps_dir) if os.path.exists(os.path.join(apps_dir, app, 'package.json'))
+		and (apps is None or app in apps))
+	package_hashes = dict((app, get_node_packages_hash(os.path.join(apps_dir, app))) for app in apps)
+
+	pending_apps = [app for app in apps if force or installed.get(app) != package_hashes[app]
+		or not os.path.isdir(os.path.join(apps_dir, app, 'node_modules'))]
+	skipped_apps = [app for app in apps if app not in pending_apps]
+	if skipped_apps:
+		log("Node packages of {0} haven't changed, skipping yarn install for them".format(", ".join(skipped_apps)))
+		record_skipped('node packages', skipped_apps, "package.json and yarn.lock haven't changed")
+
+	cache_folder = get_yarn_cache_folder(bench_path=bench_path)
+	for app in pending_apps:
+		with yarn_cache_lock(cache_folder):
+			return_code = exec_cmd(get_yarn_install_command(bench_path=bench_path), cwd=os.path.join(apps_dir, app))
+
+		if return_code == 0:
+			installed[app] = package_hashes[app]
+		else:
+			installed.pop(app, None)
+			log("yarn install failed for {0}".format(app), level=2)
+
+	set_bench_state('node_packages', installed, bench_path=bench_path)
+
+
+def get_yarn_install_command(bench_path='.'):
+	command = 'yarn install'
+	cache_folder = get_yarn_cache_folder(bench_path=bench_path)
+	if cache_folder:
+		# a cache shared by the benches on the host lets yarn install without the network
+		command += ' --prefer-offline --cache-folder {0}'.format(cache_folder)
+	return command
+
+
+def get_yarn_cache_folder(bench_path='.'):
+	from bench.config.common_site_config import get_config
+
+	yarn_cache_folder = get_config(bench_path=bench_path).get('yarn_cache_folder')
+	return os.path.abspath(os.path.expanduser(yarn_cache_folder)) if yarn_cache_folder else None
+
+
+@contextmanager
+def yarn_cache_lock(cache_folder):
+	"""Makes the benches on a host take turns at installing into a yarn cache they share"""
+	if not cache_folder:
+		yield
+		return
+
+	makedirs_safe(cache_folder)
+	with file_lock(os.path.join(cache_folder, '.bench.lock')):
+		yield
 
 
-def update_npm_packages(bench_path='.'):
+def get_node_packages_hash(app_path):
+	packages_hash = hashlib.sha1()
+	for filename in ('package.json', 'yarn.lock'):
+		path = os.path.join(app_path, filename)
+		if os.path.exists(path):
+			with open(path, 'rb') as f:
+				packages_hash.update(filename.encode('utf-8') + b'\0' + hashlib.sha1(f.read()).digest())
+	return packages_hash.hexdigest()
+
+
+def update_npm_packages(bench_path='.', force=False):
 	apps_dir = os.path.join(bench_path, 'apps')
 	package_json = {}
 
@@ -620,10 +1728,20 @@ def update_npm_packages(bench_path='.'):
 		with open(os.path.join(os.path.dirname(__file__), 'package.json'), 'r') as f:
 			package_json = json.loads(f.read())
 
+	package_json = json.dumps(package_json, indent=1, sort_keys=True)
+	package_json_hash = hashlib.sha1(package_json.encode('utf-8')).hexdigest()
+	installed = get_bench_state('node_packages', bench_path=bench_path)
+
+	if not force and installed.get('package.json') == package_json_hash and os.path.isdir(os.path.join(bench_path, 'node_modules')):
+		log("package.json hasn't changed since the last npm install, skipping it")
+		return
+
 	with open(os.path.join(bench_path, 'package.json'), 'w') as f:
-		f.write(json.dumps(package_json, indent=1, sort_keys=True))
+		f.write(package_json)
 
-	exec_cmd('npm install', cwd=bench_path)
+	if exec_cmd('npm install', cwd=bench_path) == 0:
+		installed['package.json'] = package_json_hash
+		set_bench_state('node_packages', installed, bench_path=bench_path)
 
 
 def install_requirements(req_file, user=False):
@@ -651,9 +1769,56 @@ def backup_site(site, bench_path='.'):
 		run_frappe_cmd('--site', site, 'backup', bench_path=bench_path)
 
 
-def backup_all_sites(bench_path='.'):
-	for site in get_sites(bench_path=bench_path):
-		backup_site(site, bench_path=bench_path)
+@trace.traced
+def backup_all_sites(bench_path='.', jobs=None, max_load=None, sites=None):
+	"""Backs up all sites, or the given sites, `jobs` at a time (`backup_jobs` in common_site_config,
+	1 by default).
+
+	If max_load (or `backup_max_load`) is set, a backup is only started while the 1 minute load
+	average is below it, so that backups don't starve production traffic"""
+	from bench.config.common_site_config import get_config
+
+	conf = get_config(bench_path=bench_path)
+	jobs = jobs or conf.get('backup_jobs') or 1
+	max_load = max_load or conf.get('backup_max_load')
+
+	bench.set_frappe_version(bench_path=bench_path)
+	if sites is None:
+		sites = get_sites(bench_path=bench_path)
+
+	if bench.FRAPPE_VERSION == 4:
+		for site in sites:
+			backup_site(site, bench_path=bench_path)
+		return
+
+	def backup(site):
+		prefix = "[{0}] ".format(site) if jobs > 1 else None
+		if max_load:
+			wait_for_load(max_load, prefix=prefix)
+
+		start = time.time()
+		return_code = exec_frappe_cmd('--site', site, 'backup', bench_path=bench_path, prefix=prefix)
+		if not return_code:
+			record_update_progress('backed_up_sites', site, bench_path=bench_path)
+		return (site, 'failed' if return_code else 'done', '{0:.1f}s'.format(time.time() - start))
+
+	results = run_parallel(backup, sites, jobs=jobs)
+	print_summary_table(('Site', 'Backup', 'Time'), results)
+
+	failed_sites = [site for site, status, _ in results if status == 'failed']
+	if failed_sites:
+		log("Backup failed for: {0}".format(", ".join(failed_sites)), level=2)
+		sys.exit(1)
+
+
+def wait_for_load(max_load, prefix=None):
+	"""Blocks while the 1 minute load average is above max_load"""
+	waiting = False
+	while os.getloadavg()[0] > max_load:
+		if not waiting:
+			print_line("Load average is above {0}, waiting...".format(max_load), prefix=prefix)
+			waiting = True
+		time.sleep(10)
 
 
 def is_root():
@@ -695,6 +1860,51 @@ def update_json_file(filename, ddict):
 		json.dump(content, f, indent=1, sort_keys=True)
 
 
+def makedirs_safe(path):
+	"""Creates path and its parents if they don't exist. The directories the benches on a host
+	share can be created by several of them at once, so one that appears after the check isn't
+	an error"""
+	try:
+		os.makedirs(path)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+
+
+@contextmanager
+def file_lock(path):
+	"""Holds an exclusive lock on path for the duration of the block, so that the benches on a
+	host take turns at changing the caches they share"""
+	import fcntl
+
+	with open(path, 'w') as f:
+		fcntl.flock(f, fcntl.LOCK_EX)
+		yield
+
+
+def get_bench_state(name, bench_path='.'):
+	"""Returns the state bench keeps in config/{name}.json, or an empty dict"""
+	state_file = os.path.join(bench_path, 'config', '{0}.json'.format(name))
+	try:
+		with open(state_file, 'r') as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return {}
+
+
+def set_bench_state(name, state, bench_path='.'):
+	"""Atomically replaces config/{name}.json so concurrent readers never see a partial file"""
+	config_path = os.path.join(bench_path, 'config')
+	if not os.path.isdir(config_path):
+		return
+
+	state_file = os.path.join(config_path, '{0}.json'.format(name))
+	tmp_file = '{0}.{1}.tmp'.format(state_file, os.getpid())
+	with open(tmp_file, 'w') as f:
+		json.dump(state, f, indent=1, sort_keys=True)
+	os.rename(tmp_file, state_file)
+
+
 def drop_privileges(uid_name='nobody', gid_name='nogroup'):
 	# from http://stackoverflow.com/a/2699996
 	if os.getuid() != 0:
@@ -759,29 +1969,218 @@ def run_frappe_cmd(*args, **kwargs):
 	f = get_env_cmd('python', bench_path=bench_path)
 	sites_dir = os.path.join(bench_path, 'sites')
 
-	is_async = False if from_command_line else True
-	if is_async:
-		stderr = stdout = subprocess.PIPE
-	else:
-		stderr = stdout = None
+	with trace.span(' '.join(('frappe',) + args), category='frappe', cwd=os.path.abspath(sites_dir), peak_rss_kb=None) as span:
+		return_code = run_on_helper_server(('frappe',) + args, bench_path=bench_path)
 
-	p = subprocess.Popen((f, '-m', 'frappe.utils.bench_helper', 'frappe') + args,
-		cwd=sites_dir, stdout=stdout, stderr=stderr)
+		if return_code is None:
+			is_async = False if from_command_line else True
+			if is_async:
+				stderr = stdout = subprocess.PIPE
+			else:
+				stderr = stdout = None
 
-	if is_async:
-		return_code = print_output(p)
-	else:
-		return_code = p.wait()
+			p = subprocess.Popen((f, '-m', 'frappe.utils.bench_helper', 'frappe') + args,
+				cwd=sites_dir, stdout=stdout, stderr=stderr)
+
+			if is_async:
+				return_code = print_output(p)
+			else:
+				return_code, span['peak_rss_kb'] = trace.wait(p)
+
+		span['exit_code'] = return_code
 
 	if return_code > 0:
 		sys.exit(return_code)
 
 
+def exec_frappe_cmd(*args, **kwargs):
+	"""Runs a frappe command like run_frappe_cmd, but returns its exit code instead of exiting
+	on failure. If kwargs has a prefix, every line of output is printed with it"""
+	bench_path = kwargs.get('bench_path', '.')
+	sites_dir = os.path.join(bench_path, 'sites')
+
+	with trace.span(' '.join(('frappe',) + args), category='frappe', cwd=os.path.abspath(sites_dir), peak_rss_kb=None) as span:
+		span['exit_code'], span['peak_rss_kb'] = run_frappe_process(args, bench_path, kwargs.get('prefix'))
+		return span['exit_code']
+
+
+def run_frappe_process(args, bench_path, prefix=None):
+	"""Returns the exit code and peak RSS of the frappe command, the latter only known for
+	commands that didn't run on the helper server"""
+	f = get_env_cmd('python', bench_path=bench_path)
+	sites_dir = os.path.join(bench_path, 'sites')
+
+	if get_helper_server_socket(bench_path=bench_path):
+		fds, close_fds, relay = (0, 1, 2), (), None
+		if prefix:
+			read_fd, write_fd = os.pipe()
+			fds, close_fds = (0, write_fd, write_fd), (write_fd,)
+			relay = threading.Thread(target=print_prefixed_output, args=(os.fdopen(read_fd), prefix))
+			relay.start()
+
+		return_code = run_on_helper_server(('frappe',) + args, bench_path=bench_path, fds=fds, close_fds=close_fds)
+		if relay:
+			if return_code is None:
+				try:
+					os.close(write_fd)
+				except OSError:
+					pass
+			relay.join()
+
+		if return_code is not None:
+			return return_code, None
+
+	if not prefix:
+		return trace.wait(subprocess.Popen((f, '-m', 'frappe.utils.bench_helper', 'frappe') + args, cwd=sites_dir))
+
+	p = subprocess.Popen((f, '-m', 'frappe.utils.bench_helper', 'frappe') + args, cwd=sites_dir,
+		stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+	print_prefixed_output(p.stdout, prefix)
+	return trace.wait(p)
+
+
 def get_frappe_cmd_output(*args, **kwargs):
 	bench_path = kwargs.get('bench_path', '.')
+	sites_dir = os.path.join(bench_path, 'sites')
+
+	with trace.span(' '.join(('frappe',) + args), category='frappe', cwd=os.path.abspath(sites_dir), exit_code=0, peak_rss_kb=None) as span:
+		try:
+			return read_frappe_cmd_output(args, bench_path)
+		except subprocess.CalledProcessError as e:
+			span['exit_code'] = e.returncode
+			raise
+
+
+def read_frappe_cmd_output(args, bench_path):
 	f = get_env_cmd('python', bench_path=bench_path)
 	sites_dir = os.path.join(bench_path, 'sites')
-	return subprocess.check_output((f, '-m', 'frappe.utils.bench_helper', 'frappe') + args, cwd=sites_dir)
+	cmd = (f, '-m', 'frappe.utils.bench_helper', 'frappe') + args
+
+	if get_helper_server_socket(bench_path=bench_path):
+		read_fd, write_fd = os.pipe()
+		output = []
+		reader = threading.Thread(target=lambda: output.append(os.fdopen(read_fd, 'rb').read()))
+		reader.start()
+
+		return_code = run_on_helper_server(('frappe',) + args, bench_path=bench_path,
+			fds=(0, write_fd, 2), close_fds=(write_fd,))
+		if return_code is None:
+			try:
+				os.close(write_fd)
+			except OSError:
+				pass
+		reader.join()
+
+		if return_code is not None:
+			if return_code:
+				raise subprocess.CalledProcessError(return_code, cmd, output=output[0])
+			return output[0]
+
+	return subprocess.check_output(cmd, cwd=sites_dir)
+
+
+def get_helper_server_socket(bench_path='.'):
+	"""Returns the socket of the bench's helper server, if one is running and has loaded the
+	apps currently checked out in the bench"""
+	import socket
+	from bench.cli import get_command_index_key
+
+	if not hasattr(socket.socket, 'sendmsg'):
+		return None
+
+	state = get_bench_state('helper_server', bench_path=bench_path)
+	if not state or not is_process_running(state.get('pid')):
+		return None
+
+	# the server needs Python 3's socket.recvmsg, so a server running elsewhere can't serve us
+	if not state.get('python_version', '').startswith('3'):
+		return None
+
+	socket_path = os.path.abspath(os.path.join(bench_path, 'config', 'helper_server.sock'))
+	if not os.path.exists(socket_path):
+		return None
+
+	if state.get('key') != get_command_index_key(bench_path=bench_path):
+		log("Apps have changed since the helper server started, run `bench helper-server restart` to use it again", level=3)
+		return None
+
+	return socket_path
+
+
+def run_on_helper_server(args, bench_path='.', fds=(0, 1, 2), close_fds=()):
+	"""Runs `python -m frappe.utils.bench_helper *args` on the helper server and returns its exit
+	code, or None if no helper server is available or the request couldn't be sent to it. Only
+	then may the caller run the command itself"""
+	import socket
+	from bench import helper_server
+
+	socket_path = get_helper_server_socket(bench_path=bench_path)
+	if not socket_path:
+		return None
+
+	sys.stdout.flush()
+	sys.stderr.flush()
+	try:
+		return helper_server.call(socket_path, args, cwd=os.path.join(bench_path, 'sites'), fds=fds, close_fds=close_fds)
+	except socket.error:
+		return None
+
+
+def start_helper_server(bench_path='.', foreground=False):
+	from bench.cli import get_command_index_key
+	from bench import helper_server
+
+	if get_helper_server_socket(bench_path=bench_path):
+		log("Helper server is already running")
+		return
+
+	python_version = get_env_python_version(bench_path=bench_path).split(' ')[0]
+	if not python_version.startswith('3'):
+		log("The helper server needs Python 3 in env, found {0}".format(python_version or "none"), level=2)
+		return
+
+	python = get_env_cmd('python', bench_path=bench_path)
+	socket_path = os.path.abspath(os.path.join(bench_path, 'config', 'helper_server.sock'))
+	script = helper_server.__file__.replace('.pyc', '.py')
+	cmd = [python, script, socket_path]
+	sites_dir = os.path.join(bench_path, 'sites')
+
+	if foreground:
+		set_bench_state('helper_server', {'pid': os.getpid(), 'key': get_command_index_key(bench_path=bench_path),
+			'python_version': python_version}, bench_path=bench_path)
+		os.chdir(sites_dir)
+		os.execv(python, cmd)
+
+	with open(os.path.join(bench_path, 'logs', 'helper_server.log'), 'a') as log_file:
+		p = subprocess.Popen(cmd, cwd=sites_dir, stdin=open(os.devnull), stdout=log_file, stderr=log_file,
+			preexec_fn=os.setsid, close_fds=True)
+
+	set_bench_state('helper_server', {'pid': p.pid, 'key': get_command_index_key(bench_path=bench_path),
+		'python_version': python_version}, bench_path=bench_path)
+	log("Helper server started with pid {0}".format(p.pid), level=1)
+
+
+def stop_helper_server(bench_path='.'):
+	import signal
+
+	state = get_bench_state('helper_server', bench_path=bench_path)
+	if is_process_running(state.get('pid')):
+		os.kill(state['pid'], signal.SIGTERM)
+		log("Helper server stopped", level=1)
+	else:
+		log("Helper server is not running")
+
+	set_bench_state('helper_server', {}, bench_path=bench_path)
+
+
+def is_process_running(pid):
+	if not pid:
+		return False
+	try:
+		os.kill(pid, 0)
+	except OSError as e:
+		return e.errno == errno.EPERM
+	return True
 
 
 def validate_upgrade(from_ver, to_ver, bench_path='.'):
@@ -818,6 +2217,8 @@ sudo supervisorctl reload
 
 
 def update_translations_p(args):
+	import requests
+
 	try:
 		update_translations(*args)
 	except requests.exceptions.HTTPError:
@@ -849,6 +2250,8 @@ def get_langs():
 
 
 def update_translations(app, lang):
+	import requests
+
 	translations_dir = os.path.join('apps', app, app, 'translations')
 	csv_file = os.path.join(translations_dir, lang + '.csv')
 	url = "https://translate.erpnext.com/files/{}-{}.csv".format(app, lang)
@@ -1043,7 +2446,7 @@ def in_virtual_env():
 
 def migrate_env(python, backup=False):
 	from bench.config.common_site_config import get_config
-	from bench.app import get_apps
+	from bench.app import get_apps, install_apps
 
 	log = logging.getLogger(__name__)
 	log.setLevel(logging.DEBUG)
@@ -1053,7 +2456,6 @@ def migrate_env(python, backup=False):
 	python = which(python)
 	virtualenv = which('virtualenv')
 	pvenv = os.path.join(path, nvenv)
-	pip = os.path.join(pvenv, 'bin', 'pip')
 
 	# Clear Cache before Bench Dies.
 	try:
@@ -1090,8 +2492,9 @@ def migrate_env(python, backup=False):
 		log.debug('Setting up a New Virtual {} Environment'.format(python))
 		exec_cmd('{virtualenv} --python {python} {pvenv}'.format(virtualenv=virtualenv, python=python, pvenv=pvenv))
 
-		apps = ' '.join(["-e {}".format(os.path.join("apps", app)) for app in get_apps()])
-		exec_cmd('{0} install -q -U {1}'.format(pip, apps))
+		failed_apps = install_apps(get_apps(), bench_path=path)
+		if failed_apps:
+			log.warn('Could not install {0} in the new environment'.format(', '.join(failed_apps)))
 
 		log.debug('Migration Successful to {}'.format(python))
 	except:
@@ -9,11 +9,17 @@ _bench_completion() {
         # bench_helper.py expects to be executed from "sites" directory
         cd sites
 
-        # All frappe commands are subcommands under "bench frappe"
-        # Frappe is only installed in virtualenv "env" so use appropriate python executable
-        COMPREPLY+=( $( COMP_WORDS="bench frappe "${COMP_WORDS[@]:1} \
-                        COMP_CWORD=$(($COMP_CWORD+1)) \
-                        _BENCH_COMPLETE=complete ../env/bin/python ../apps/frappe/frappe/utils/bench_helper.py ) )
+        if [ $COMP_CWORD -eq 1 ] && [ -f "../config/frappe_commands.json" ]; then
+            # Top level frappe commands are read from the command index bench maintains,
+            # which saves importing frappe on every tab press
+            COMPREPLY+=( $( compgen -W "$( ../env/bin/python -c 'import json; print(" ".join(json.load(open("../config/frappe_commands.json"))["commands"]))' )" -- "${COMP_WORDS[COMP_CWORD]}" ) )
+        else
+            # All frappe commands are subcommands under "bench frappe"
+            # Frappe is only installed in virtualenv "env" so use appropriate python executable
+            COMPREPLY+=( $( COMP_WORDS="bench frappe "${COMP_WORDS[@]:1} \
+                            COMP_CWORD=$(($COMP_CWORD+1)) \
+                            _BENCH_COMPLETE=complete ../env/bin/python ../apps/frappe/frappe/utils/bench_helper.py ) )
+        fi
 
         # If the word before the current cursor position in command typed so far is "--site" then only list sites
         if [ ${COMP_WORDS[COMP_CWORD-1]} == "--site" ]; then